@@ -0,0 +1,262 @@
+"""
+利用履歴の集計エンジン。
+
+履歴の「利用を記録しました」ログを、時刻・子機・利用者の列ごとの NumPy 配列に読み込んでキャッシュする。
+2回目以降は前回より新しい履歴だけを読み足し、集計は bincount などのベクトル演算で行う。
+時刻は履歴の created_at (UNIX時刻) を現地時刻の 1970-01-01 00:00 からの分数にしたもの
+(created_at を持たないアーカイブの行だけは、ログに書かれた時刻を使う)。
+期間を指定した集計は、DBに残っている履歴を created_at のインデックスで絞り込んで読む。
+"""
+import re
+import threading
+import time
+
+import numpy as np
+
+REFRESH_BATCH_SIZE = 5000      # 1回のクエリで読む履歴の件数
+MINUTES_PER_DAY = 24 * 60
+WEEKDAY_LABELS = ['月', '火', '水', '木', '金', '土', '日']
+
+
+def to_minutes(dt):
+    """datetime を集計用の分数に変換する"""
+    return int(np.datetime64(dt.replace(second=0, microsecond=0), 'm').astype(np.int64))
+
+
+def epoch_to_minutes_array(epochs):
+    """UNIX時刻 (秒) の配列を集計用の分数の配列にする。時差は1時間ごとにまとめて求める"""
+    epochs = np.asarray(epochs, dtype=np.int64)
+    hours, inverse = np.unique(epochs // 3600, return_inverse=True)
+    offsets = np.array([time.localtime(int(hour) * 3600).tm_gmtoff for hour in hours], dtype=np.int64)
+    return (epochs + offsets[inverse.reshape(-1)]) // 60
+
+
+def weekday_of(minutes):
+    """分数の配列から曜日 (月曜=0) を求める。1970-01-01 は木曜日"""
+    return (minutes // MINUTES_PER_DAY + 3) % 7
+
+
+class UsageAnalytics:
+    """
+    利用ログを列ごとの配列で保持する集計エンジン。
+    refresh で新しい履歴を取り込み、各集計メソッドはその時点の配列から計算する。
+    """
+
+    def __init__(self, marker):
+        # 例: "2025-08-09 19:00: [raspi-01] 利用を記録しました (011009100c1d5f14)"
+        self.pattern = re.compile(
+            r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}): \[(.*?)\] ' + re.escape(marker) + r' \((.*?)\)'
+        )
+        self.marker = marker
+        self.lock = threading.Lock()
+        self.loaded = False   # アーカイブを読み込み済みか
+        self.last_id = 0      # 取り込み済みの最後の履歴ID
+        self.unit_names = []  # 子機コード -> 子機名
+        self.unit_codes = {}
+        self.card_ids = []    # 利用者コード -> カードID
+        self.card_codes = {}
+        self.ids = np.empty(0, dtype=np.int64)
+        self.minutes = np.empty(0, dtype=np.int64)
+        self.units = np.empty(0, dtype=np.int32)
+        self.users = np.empty(0, dtype=np.int32)
+
+    # --- 読み込み ---
+
+    def refresh(self, db, archived_rows=None):
+        """
+        前回より新しい利用ログを履歴から読み足す。
+        初回は archived_rows (アーカイブ済みの (id, txt) を返す関数) も読み込む。
+        """
+        with self.lock:
+            chunks = []
+            if not self.loaded:
+                if archived_rows is not None:
+                    chunks.append(self._parse((row_id, None, txt) for row_id, txt in archived_rows()))
+                self.loaded = True
+            while True:
+                rows = db.execute(
+                    "SELECT id, created_at, txt FROM history WHERE id > ? AND txt LIKE ? ORDER BY id LIMIT ?",
+                    (self.last_id, f"%{self.marker}%", REFRESH_BATCH_SIZE)
+                ).fetchall()
+                if not rows:
+                    break
+                self.last_id = rows[-1][0]
+                chunks.append(self._parse(rows))
+            if chunks:
+                self.ids = np.concatenate([self.ids] + [c[0] for c in chunks])
+                self.minutes = np.concatenate([self.minutes] + [c[1] for c in chunks])
+                self.units = np.concatenate([self.units] + [c[2] for c in chunks])
+                self.users = np.concatenate([self.users] + [c[3] for c in chunks])
+
+    def query(self, db, since=None, until=None):
+        """
+        期間 [since, until) (UNIX時刻) の (時刻, 子機コード, 利用者コード) の配列を返す。
+        DBに残っている履歴は created_at のインデックスで絞り込んで読み、
+        アーカイブに移った分 (履歴の最小idより前) だけをキャッシュから取り出す。refresh の後に呼ぶ。
+        """
+        conditions, params = ["txt LIKE ?"], [f"%{self.marker}%"]
+        if since is not None:
+            conditions.append("created_at >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("created_at < ?")
+            params.append(until)
+        # 途中で履歴がアーカイブに移っても数え漏れ・二重計上がないよう、同じ読み取りトランザクションで読む
+        db.execute("BEGIN")
+        try:
+            first_id = db.execute("SELECT MIN(id) FROM history").fetchone()[0]
+            rows = db.execute(
+                f"SELECT id, created_at, txt FROM history WHERE {' AND '.join(conditions)}", params
+            ).fetchall()
+        finally:
+            db.commit()
+        with self.lock:
+            _, minutes, units, users = self._parse(rows)
+            archived = self.ids < first_id if first_id is not None else np.ones(len(self.ids), dtype=bool)
+            if since is not None:
+                archived &= self.minutes >= epoch_to_minutes_array([since])[0]
+            if until is not None:
+                archived &= self.minutes < epoch_to_minutes_array([until])[0]
+            return (
+                np.concatenate([self.minutes[archived], minutes]),
+                np.concatenate([self.units[archived], units]),
+                np.concatenate([self.users[archived], users]),
+            )
+
+    def _parse(self, rows):
+        """
+        (id, created_at, txt) の行から利用ログを取り出し、(id, 時刻, 子機コード, 利用者コード) の配列にする。
+        時刻は created_at から求め、created_at がない行 (アーカイブ) だけログの時刻の文字列を使う。
+        """
+        ids, epochs, texts, units, users = [], [], [], [], []
+        text_ids, text_units, text_users = [], [], []
+        for row_id, created_at, txt in rows:
+            match = self.pattern.match(txt)
+            if not match:
+                continue
+            unit = self._code(match.group(2), self.unit_names, self.unit_codes)
+            user = self._code(match.group(3), self.card_ids, self.card_codes)
+            if created_at is not None:
+                ids.append(row_id)
+                epochs.append(created_at)
+                units.append(unit)
+                users.append(user)
+            else:
+                text_ids.append(row_id)
+                texts.append(match.group(1))
+                text_units.append(unit)
+                text_users.append(user)
+        # 時刻はまとめて NumPy で変換する
+        minutes = np.concatenate([
+            epoch_to_minutes_array(epochs),
+            np.array(texts, dtype='datetime64[m]').astype(np.int64),
+        ])
+        return (
+            np.array(ids + text_ids, dtype=np.int64),
+            minutes,
+            np.array(units + text_units, dtype=np.int32),
+            np.array(users + text_users, dtype=np.int32),
+        )
+
+    @staticmethod
+    def _code(value, names, codes):
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(names)
+            names.append(value)
+        return code
+
+    def snapshot(self, since=None, until=None):
+        """期間 [since, until) の (時刻, 子機コード, 利用者コード) の配列を返す"""
+        with self.lock:
+            minutes, units, users = self.minutes, self.units, self.users
+        mask = np.ones(len(minutes), dtype=bool)
+        if since is not None:
+            mask &= minutes >= since
+        if until is not None:
+            mask &= minutes < until
+        return minutes[mask], units[mask], users[mask]
+
+    # --- 集計 ---
+
+    def select(self, since=None, until=None, rows=None):
+        """集計対象の配列。rows (query の結果) があればそれを、なければキャッシュの期間 [since, until) を返す"""
+        return rows if rows is not None else self.snapshot(since=since, until=until)
+
+    def totals(self, since=None, until=None, rows=None):
+        """時間別・日別・曜日別の利用回数"""
+        minutes, _, _ = self.select(since, until, rows)
+        days, day_counts = np.unique(minutes // MINUTES_PER_DAY, return_counts=True)
+        return {
+            'hourly': np.bincount((minutes // 60) % 24, minlength=24).tolist(),
+            'daily_labels': days.astype('datetime64[D]').astype(str).tolist(),
+            'daily': day_counts.tolist(),
+            'weekly': np.bincount(weekday_of(minutes), minlength=7).tolist(),
+        }
+
+    def unit_consumption(self, units, days, now):
+        """
+        子機ごとの消費ペースと在庫切れまでの見込み。
+        units は (子機名, 在庫数) のリスト。直近 days 日の利用回数から1日あたりの消費数を求め、
+        在庫切れが早い順に並べて返す (利用がない子機は最後)。
+        """
+        now_minutes = to_minutes(now)
+        minutes, unit_codes, _ = self.snapshot(since=now_minutes - days * MINUTES_PER_DAY)
+        counts = np.bincount(unit_codes, minlength=len(self.unit_names))
+        # 記録が days 日に満たない場合は、実際の期間で割る (最短1日)
+        if len(minutes):
+            span_days = max(1.0, min(days, (now_minutes - minutes.min()) / MINUTES_PER_DAY))
+        else:
+            span_days = float(days)
+
+        names = [name for name, _ in units]
+        codes = np.array([self.unit_codes.get(name, -1) for name in names], dtype=np.int64)
+        used = np.append(counts, 0)[codes]  # 履歴にない子機 (コード -1) は末尾の0を参照する
+        stock = np.array([max(stock or 0, 0) for _, stock in units], dtype=np.float64)
+        rate = used / span_days
+        with np.errstate(divide='ignore'):
+            eta_days = np.where(rate > 0, stock / rate, np.inf)
+
+        result = []
+        for i in np.argsort(eta_days, kind='stable'):
+            eta = None if np.isinf(eta_days[i]) else float(eta_days[i])
+            result.append({
+                'name': names[i],
+                'stock': int(stock[i]),
+                'used': int(used[i]),
+                'rate_per_day': round(float(rate[i]), 2),
+                'eta_days': round(eta, 1) if eta is not None else None,
+                'empty_at': (np.datetime64(now_minutes, 'm') + int(eta * MINUTES_PER_DAY)).astype(str)
+                            if eta is not None else None,
+            })
+        return result
+
+    def user_frequency(self, since, until=None, limit=20, max_bucket=20, rows=None):
+        """
+        利用者ごとの利用回数。
+        利用の多い順に limit 人と、利用回数ごとの人数の分布 (max_bucket 回以上はまとめる) を返す。
+        """
+        _, _, user_codes = self.select(since, until, rows)
+        counts = np.bincount(user_codes, minlength=len(self.card_ids))
+        active = np.flatnonzero(counts)
+        top = active[np.argsort(-counts[active], kind='stable')[:limit]]
+        distribution = np.bincount(np.minimum(counts[active], max_bucket), minlength=max_bucket + 1)[1:]
+        return {
+            'total_uses': int(counts.sum()),
+            'active_users': int(len(active)),
+            'top': [{'card_id': self.card_ids[i], 'count': int(counts[i])} for i in top],
+            'distribution_labels': [str(k) for k in range(1, max_bucket)] + [f"{max_bucket}+"],
+            'distribution': distribution.tolist(),
+        }
+
+    def heatmap(self, since, until=None, rows=None):
+        """曜日 (行, 月曜から) × 時間帯 (列, 0時から) の利用回数"""
+        minutes, _, _ = self.select(since, until, rows)
+        cells = weekday_of(minutes) * 24 + (minutes // 60) % 24
+        grid = np.bincount(cells, minlength=7 * 24).reshape(7, 24)
+        return {
+            'weekday_labels': WEEKDAY_LABELS,
+            'hour_labels': [f"{h:02d}" for h in range(24)],
+            'counts': grid.tolist(),
+            'max': int(grid.max()),
+        }
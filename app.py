@@ -6,11 +6,25 @@ import io
 import pandas as pd
 import traceback
 import re  # 利用履歴抽出用
+import json
+import csv
+import gzip
+import threading
+import time
+import queue
+import uuid
+import secrets
+import hmac
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
 from werkzeug.utils import secure_filename
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
 from datetime import datetime, timedelta  # timedelta を追加
+from analytics import UsageAnalytics, to_minutes, MINUTES_PER_DAY
 from flask import (
     Flask, request, jsonify, render_template,
-    redirect, url_for, session, flash, g, send_file
+    redirect, url_for, session, flash, g, send_file, Response, make_response
 )
 try:
     import nfc
@@ -21,7 +35,97 @@ except ImportError:
 # templates と static フォルダをデフォルトに変更
 app = Flask(__name__, template_folder='templates', static_folder='static')
 app.secret_key = 'oiteru_secret_key_2025_final'
-DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'oiteru.sqlite3')
+# 同じPCで複数の親機を動かせるよう、DBなどの保存先とポートは環境変数で変更できる
+DB_PATH = os.environ.get('OITERU_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'oiteru.sqlite3'))
+ARCHIVE_DIR = os.environ.get('OITERU_ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive'))
+JOB_DIR = os.environ.get('OITERU_JOB_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'job_artifacts'))
+SERVER_PORT = int(os.environ.get('OITERU_PORT', '5000'))
+
+# --- 子機設定 ---
+# ハートビートの応答で子機に配信する設定の既定値。
+# 子機ごとの上書きは units.settings (JSON) に保存し、変更のたびに units.config_version を上げる。
+DEFAULT_UNIT_SETTINGS = {
+    'heartbeat_interval': 30,      # ハートビート送信間隔 (秒)
+    'indicate_seconds': 2,         # LEDの点灯時間 (秒)
+    'dispense_max_attempts': 15,   # センサー連携時のモーター試行回数の上限
+}
+# 子機ごとに上書きできる設定キー (モーター設定は子機側の既定値を使う場合は指定しない)
+UNIT_SETTING_KEYS = set(DEFAULT_UNIT_SETTINGS) | {'motor_type', 'control_method', 'use_sensor'}
+# 選択肢が決まっている設定の値 (unit_client.py の MOTOR_TYPE / CONTROL_METHOD と合わせる)
+UNIT_SETTING_CHOICES = {
+    'motor_type': ('SERVO', 'STEPPER'),
+    'control_method': ('RASPI_DIRECT', 'ARDUINO_SERIAL'),
+}
+HEARTBEAT_BATCH_MAX = 64       # まとめて送れるハートビートの数 (1プロセスで動かす子機の数の上限)
+
+# --- 子機の認証トークン ---
+# 子機は名前とパスワードを一度だけ送って署名付きトークンを受け取り、以降のAPIはトークンで認証する。
+UNIT_TOKEN_TTL = 12 * 60 * 60  # トークンの有効期間 (秒)
+UNIT_TOKEN_KEYS_KEPT = 2       # 鍵をローテーションした後も検証に使う鍵の数 (新しい鍵を含む)
+
+# --- 履歴検索 ---
+HISTORY_PAGE_SIZE = 100  # 履歴検索の1ページあたりの表示件数
+
+# --- 履歴の保存期間とアーカイブ ---
+# 保存期間を過ぎた履歴は ARCHIVE_DIR の月別ファイル (history-YYYY-MM.csv.gz) に移す。
+# 可視化ページの集計エンジンは初回の読み込み時にアーカイブファイルの利用ログも読み込む。
+HISTORY_RETENTION_DAYS = 180   # historyテーブルに残す日数
+ARCHIVE_BATCH_SIZE = 1000      # 1トランザクションで移動する件数
+ARCHIVE_INTERVAL = 60 * 60     # バックグラウンドでアーカイブを実行する間隔 (秒)
+VACUUM_FREE_RATIO = 0.2        # 空きページがこの割合を超えたら VACUUM する
+VACUUM_HOURS = range(3, 5)     # 自動 VACUUM を行う時間帯 (利用の少ない深夜)
+USAGE_LOG_MARKER = '利用を記録しました'
+
+# --- 利用状況の集計 ---
+ANALYTICS_RATE_DAYS = 7        # 子機の消費ペースを求める期間 (日)
+ANALYTICS_HEATMAP_DAYS = 28    # 曜日×時間帯ヒートマップの期間 (日)
+ANALYTICS_TOP_USERS = 20       # 利用の多い利用者として表示する人数
+
+# --- カード情報キャッシュ ---
+CARD_CACHE_SIZE = 4096  # キャッシュする利用者数の上限 (0でキャッシュ無効)
+
+# --- 管理画面の表示キャッシュ ---
+RENDER_CACHE_SIZE = 64  # 描画済みのHTMLを保持するページ (URL) 数の上限 (0でキャッシュ無効)
+
+# --- 一括登録 ---
+ENROLL_BATCH_SIZE = 50         # 連続登録モードでまとめてコミットする件数
+ENROLL_FLUSH_INTERVAL = 1.0    # 連続登録モードで件数に達しなくてもコミットする間隔 (秒)
+ENROLL_DEBOUNCE_SECONDS = 3.0  # 同じカードを置いたままの場合に読み飛ばす時間 (秒)
+ENROLL_FEED_SIZE = 500         # 画面に流す登録結果の保持件数
+BULK_IMPORT_BATCH_SIZE = 500   # 一括インポートで1回の executemany に渡す件数
+
+# --- イベント配信 (SSE) ---
+SSE_KEEPALIVE_SECONDS = 15     # イベントがない間に接続維持のコメントを送る間隔 (秒)
+SSE_QUEUE_SIZE = 1000          # 接続ごとに溜めておけるイベント数 (超えた分は捨てる)
+UNIT_TIMEOUT_CHECK_INTERVAL = 15  # 子機のタイムアウトを確認する間隔 (秒)
+
+# --- バックグラウンドジョブ ---
+JOB_MAX_WORKERS = 2            # 同時に実行するジョブの数
+JOB_MAX_PENDING = 10           # 待機中・実行中のジョブ数の上限
+JOB_RETENTION_HOURS = 24       # 完了したジョブと成果物を残しておく時間
+EXPORT_BATCH_SIZE = 5000       # エクスポート時に1回のクエリで読む履歴の件数
+
+# --- 利用記録の重複防止 ---
+USAGE_DEDUP_TTL_HOURS = 24     # 子機のタップIDと結果を覚えておく時間
+TAP_ID_MAX_LENGTH = 64         # タップIDとして受け付ける最大文字数
+
+# --- DBマイグレーション ---
+MIGRATION_BATCH_SIZE = 5000    # 大きな表を埋め直すときに1トランザクションで処理する行数
+MIGRATION_BATCH_PAUSE = 0.01   # バッチの間に書き込みを譲る時間 (秒)
+
+# --- 拠点間の同期 ---
+# standalone: 1台の親機で全てを管理 (既定)
+# central: 各建物のエッジから利用記録を受け取り、利用者情報の正本を持つ中央の親機
+# edge: 建物の子機を自分のDBで処理し、利用記録と利用者の変更を非同期に中央と同期する親機
+SITE_MODE = os.environ.get('OITERU_SITE_MODE', 'standalone')
+SITE_NAME = os.environ.get('OITERU_SITE_NAME', 'main')           # 中央の履歴に付ける拠点名
+CENTRAL_URL = os.environ.get('OITERU_CENTRAL_URL', '').rstrip('/')  # エッジから見た中央の親機のURL
+FEDERATION_KEY = os.environ.get('OITERU_FEDERATION_KEY', '')     # 中央とエッジで共有する鍵
+FEDERATION_SYNC_INTERVAL = 5     # エッジが中央と同期する間隔 (秒)
+FEDERATION_MAX_BACKOFF = 300     # 同期に失敗したときに待つ最大の間隔 (秒)
+FEDERATION_BATCH_SIZE = 500      # 1回のリクエストで送受信するイベント・変更の件数
+FEDERATION_TIMEOUT = 10          # 中央へのリクエストのタイムアウト (秒)
+FEDERATION_APPLIED_TTL_DAYS = 30  # 中央が反映済みのイベントIDを覚えておく日数
 
 
 # --- DB Helpers ---
@@ -40,80 +144,755 @@ def close_connection(exception):
     if db is not None:
         db.close()
 
-# --- データベース初期化 ---
-def init_db():
-    """データベースのテーブルを初期化する"""
-    if os.path.exists(DB_PATH):
-        print("データベースは既に存在します。")
+# --- DBマイグレーション ---
+# スキーマのバージョンを PRAGMA user_version に記録し、起動時に未適用のマイグレーションだけを順に実行する。
+# バージョン管理を始める前に手作業で更新されたDB (user_version = 0) もあるため、
+# 各マイグレーションは既にある表・カラム・インデックスを作り直さず、途中で止まっても再実行できるように書く。
+def table_exists(db, name):
+    return db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?", (name,)
+    ).fetchone() is not None
+
+def backfill_in_batches(db, table, label, apply_batch, batch_size=MIGRATION_BATCH_SIZE,
+                        start_id=0, max_id=None, on_progress=None):
+    """
+    table の既存の行 (start_id より後で max_id まで。max_id の省略時は現在の最大id) を
+    id 順に batch_size 件ずつ apply_batch(db, 最初のid, 最後のid) で処理し、バッチごとにコミットする。
+    書き込みロックを短く保つため、稼働中の親機を止めずに実行できる。
+    on_progress(db, 処理済みの最後のid) はバッチと同じトランザクションで呼ぶ (途中から再開するための記録用)。
+    処理した行数を返す。
+    """
+    if max_id is None:
+        max_id = db.execute(f"SELECT MAX(id) FROM {table}").fetchone()[0] or 0
+    started = time.perf_counter()
+    last_id = start_id
+    done = 0
+    while last_id < max_id:
+        ids = db.execute(
+            f"SELECT id FROM {table} WHERE id > ? AND id <= ? ORDER BY id LIMIT ?",
+            (last_id, max_id, batch_size)
+        ).fetchall()
+        if not ids:
+            break
+        with db:
+            apply_batch(db, ids[0][0], ids[-1][0])
+            if on_progress:
+                on_progress(db, ids[-1][0])
+        last_id = ids[-1][0]
+        done += len(ids)
+        print(f"     {label}: {done}件 ({last_id}/{max_id}, {time.perf_counter() - started:.1f}秒)")
+        time.sleep(MIGRATION_BATCH_PAUSE)
+    return done
+
+def migrate_base_tables(db):
+    """users / units / history / info テーブルを作成し、古いDBの units に不足しているカラムを追加する"""
+    with db:
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                card_id TEXT UNIQUE NOT NULL,
+                allow INTEGER DEFAULT 1,
+                entry TEXT,
+                stock INTEGER DEFAULT 2,
+                today INTEGER DEFAULT 0,
+                total INTEGER DEFAULT 0,
+                last1 TEXT, last2 TEXT, last3 TEXT, last4 TEXT, last5 TEXT,
+                last6 TEXT, last7 TEXT, last8 TEXT, last9 TEXT, last10 TEXT
+            )
+        ''')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS units (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT UNIQUE NOT NULL,
+                password TEXT NOT NULL,
+                stock INTEGER DEFAULT 0,
+                connect INTEGER DEFAULT 0,
+                available INTEGER DEFAULT 1,
+                last_seen TEXT,
+                config_version INTEGER DEFAULT 1,
+                settings TEXT
+            )
+        ''')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                txt TEXT NOT NULL
+            )
+        ''')
+        # 管理者パスワード (pass に sha256) などの設定
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS info (
+                id INTEGER PRIMARY KEY,
+                pass TEXT NOT NULL,
+                daycount INTEGER,
+                updatecount INTEGER,
+                freq INTEGER,
+                maximum INTEGER,
+                backup TEXT,
+                list TEXT
+            )
+        ''')
+    columns = [row['name'] for row in db.execute("PRAGMA table_info(units)")]
+    for column, column_type in [
+        ('last_seen', 'TEXT'),
+        ('config_version', 'INTEGER DEFAULT 1'),
+        ('settings', 'TEXT'),
+    ]:
+        if column not in columns:
+            print(f"     unitsテーブルに '{column}' カラムを追加します。")
+            db.execute(f"ALTER TABLE units ADD COLUMN {column} {column_type}")
+            db.commit()
+
+def migrate_history_fts(db):
+    """
+    history テーブルの全文検索インデックス (FTS5) とそれを維持するトリガーを作成する。
+    日本語のログも部分一致で検索できるよう trigram トークナイザを使う。
+    既存の履歴の登録は migration_progress に進み具合を残し、途中で止まっても続きから再開する。
+    """
+    try:
+        if not table_exists(db, 'history_fts'):
+            create_history_fts(db)
+    except sqlite3.OperationalError as e:
+        print(f"  -> 警告: 全文検索インデックスを作成できませんでした (LIKE検索で代替します): {e}")
         return
+    progress = db.execute(
+        "SELECT last_id, max_id FROM migration_progress WHERE name = 'history_fts'"
+    ).fetchone() if table_exists(db, 'migration_progress') else None
+    if progress is None:
+        return  # 登録済み
+    # トリガーを作る前からある履歴を少しずつインデックスに登録する (それ以降の履歴はトリガーで登録される)
+    backfill_in_batches(
+        db, 'history', '全文検索インデックス',
+        lambda db, first, last: db.execute(
+            "INSERT INTO history_fts (rowid, txt) SELECT id, txt FROM history WHERE id BETWEEN ? AND ?",
+            (first, last)
+        ),
+        start_id=progress['last_id'], max_id=progress['max_id'],
+        on_progress=lambda db, last: db.execute(
+            "UPDATE migration_progress SET last_id = ? WHERE name = 'history_fts'", (last,)
+        )
+    )
+    with db:
+        db.execute("DELETE FROM migration_progress WHERE name = 'history_fts'")
+
+def create_history_fts(db):
+    """
+    全文検索インデックスとトリガーを作成し、登録が必要な履歴の範囲 (トリガー作成時点の最大id まで) を記録する。
+    トリガー作成と最大idの読み取りを同じトランザクションで行い、登録漏れや二重登録を防ぐ。
+    """
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS migration_progress (
+                name TEXT PRIMARY KEY,
+                last_id INTEGER NOT NULL,
+                max_id INTEGER NOT NULL
+            )
+        """)
+        db.execute("""
+            CREATE VIRTUAL TABLE history_fts USING fts5(
+                txt, content='history', content_rowid='id', tokenize='trigram'
+            )
+        """)
+        db.execute("""
+            CREATE TRIGGER history_fts_ai AFTER INSERT ON history BEGIN
+                INSERT INTO history_fts (rowid, txt) VALUES (new.id, new.txt);
+            END
+        """)
+        db.execute("""
+            CREATE TRIGGER history_fts_ad AFTER DELETE ON history BEGIN
+                INSERT INTO history_fts (history_fts, rowid, txt) VALUES ('delete', old.id, old.txt);
+            END
+        """)
+        db.execute("""
+            CREATE TRIGGER history_fts_au AFTER UPDATE ON history BEGIN
+                INSERT INTO history_fts (history_fts, rowid, txt) VALUES ('delete', old.id, old.txt);
+                INSERT INTO history_fts (rowid, txt) VALUES (new.id, new.txt);
+            END
+        """)
+        max_id = db.execute("SELECT MAX(id) FROM history").fetchone()[0] or 0
+        db.execute(
+            "INSERT OR REPLACE INTO migration_progress (name, last_id, max_id) VALUES ('history_fts', 0, ?)",
+            (max_id,)
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+def migrate_history_usage_stats(db):
+    """アーカイブ済み履歴の利用回数を日・時間ごとに集計して残すテーブル"""
+    with db:
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS history_usage_stats (
+                day TEXT NOT NULL,
+                hour INTEGER NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, hour)
+            )
+        """)
+
+def migrate_usage_dedup(db):
+    """利用記録の重複防止テーブル (子機のタップIDと最初の応答を保存する)"""
+    with db:
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS usage_dedup (
+                unit_id INTEGER NOT NULL,
+                tap_id TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                status INTEGER NOT NULL,
+                response TEXT NOT NULL,
+                PRIMARY KEY (unit_id, tap_id)
+            ) WITHOUT ROWID
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS idx_usage_dedup_created_at ON usage_dedup (created_at)")
+
+def migrate_federation_tables(db):
+    """拠点間の同期に使うテーブル (トリガーは動作モードに合わせて setup_federation_triggers で作成する)"""
+    with db:
+        # エッジ: 中央へ送るイベント (利用者の更新と同じトランザクションで書き込む)
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS federation_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                event_id TEXT UNIQUE NOT NULL,
+                kind TEXT NOT NULL,
+                card_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            )
+        """)
+        # エッジ: 中央の変更をどこまで取り込んだか
+        db.execute("CREATE TABLE IF NOT EXISTS federation_state (key TEXT PRIMARY KEY, value TEXT)")
+        # 中央: 反映済みのイベントID (エッジからの再送を二重に反映しないため)
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS federation_applied (
+                site TEXT NOT NULL,
+                event_id TEXT NOT NULL,
+                applied_at INTEGER NOT NULL,
+                PRIMARY KEY (site, event_id)
+            ) WITHOUT ROWID
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS idx_federation_applied_at ON federation_applied (applied_at)")
+        # 中央: 変更された利用者のカードID (seq がエッジの取り込み位置になる)
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS user_changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                card_id TEXT NOT NULL
+            )
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS idx_user_changes_card_id ON user_changes (card_id)")
+
+def migrate_table_versions(db):
+    """
+    テーブルが変更されるたびに table_versions のバージョンを上げるトリガーを作成する。
+    管理画面の表示キャッシュはこのバージョンをキーにするため、どの経路で書き込んでも古い画面は返らない。
+    """
+    if table_exists(db, 'table_versions'):
+        return
+    # 子機はハートビートのたびに last_seen を更新するため、一覧に表示するカラムの変更だけを数える
+    units_changed = ' OR '.join(
+        f"old.{column} IS NOT new.{column}" for column in ('name', 'password', 'stock', 'connect', 'available')
+    )
+    with db:
+        db.execute("""
+            CREATE TABLE table_versions (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+        """)
+        for table in ('users', 'units', 'history'):
+            db.execute("INSERT INTO table_versions (name) VALUES (?)", (table,))
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                when = f"WHEN {units_changed} " if (table, event) == ('units', 'UPDATE') else ""
+                db.execute(f"""
+                    CREATE TRIGGER table_versions_{table}_{event.lower()} AFTER {event} ON {table} {when}BEGIN
+                        UPDATE table_versions SET version = version + 1 WHERE name = '{table}';
+                    END
+                """)
+
+def migrate_query_indexes(db):
+    """
+    よく使う検索のインデックス。
+    履歴はログ先頭の時刻 (YYYY-MM-DD HH:MM) で期間を絞り込み、子機はオンラインの子機を最終接続時刻で調べる。
+    """
+    with db:
+        db.execute("CREATE INDEX IF NOT EXISTS idx_history_time ON history (substr(txt, 1, 16))")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_units_connect_last_seen ON units (connect, last_seen)")
+        db.execute("ANALYZE")
+
+def migrate_epoch_columns(db):
+    """
+    イベントの時刻を UNIX時刻 (秒) の整数カラムにも保存し、期間の絞り込みをインデックスで行えるようにする。
+    history.created_at (記録時刻)、units.last_seen_at (最終接続)、users.last_used_at (最終利用)。
+    表示用の文字列のカラムはそのまま残す。既存の行は現地時刻の文字列から変換する。
+    """
+    for table, column in (('history', 'created_at'), ('units', 'last_seen_at'), ('users', 'last_used_at')):
+        columns = [row['name'] for row in db.execute(f"PRAGMA table_info({table})")]
+        if column not in columns:
+            db.execute(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER")
+            db.commit()
+    # strftime('%s', ..., 'utc') は現地時刻の文字列を UNIX時刻に変換する (形式が不正なら NULL)
+    backfill_in_batches(db, 'history', '履歴の時刻', lambda db, first, last: db.execute(
+        "UPDATE history SET created_at = CAST(strftime('%s', substr(txt, 1, 16), 'utc') AS INTEGER) "
+        "WHERE id BETWEEN ? AND ? AND created_at IS NULL", (first, last)
+    ))
+    backfill_in_batches(db, 'users', '最終利用時刻', lambda db, first, last: db.execute(
+        "UPDATE users SET last_used_at = CAST(strftime('%s', last1, 'utc') AS INTEGER) "
+        "WHERE id BETWEEN ? AND ? AND last_used_at IS NULL AND last1 IS NOT NULL", (first, last)
+    ))
+    with db:
+        db.execute(
+            "UPDATE units SET last_seen_at = CAST(strftime('%s', last_seen, 'utc') AS INTEGER) "
+            "WHERE last_seen_at IS NULL AND last_seen IS NOT NULL"
+        )
+        # 文字列の時刻に対するインデックスは整数カラムのものに置き換える
+        db.execute("DROP INDEX IF EXISTS idx_history_time")
+        db.execute("DROP INDEX IF EXISTS idx_units_connect_last_seen")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_history_created_at ON history (created_at)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_units_connect_last_seen_at ON units (connect, last_seen_at)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_users_last_used_at ON users (last_used_at)")
+        db.execute("ANALYZE")
+
+def drop_history_usage_stats(db):
+    """
+    v3 の history_usage_stats を削除する。
+    集計エンジンは利用者・子機ごとの集計にアーカイブの利用ログそのものを使うため、日・時間ごとの件数は参照されていなかった。
+    """
+    with db:
+        db.execute("DROP TABLE IF EXISTS history_usage_stats")
+
+# (バージョン, 内容, 関数)。新しいマイグレーションは末尾に追加し、既存のものは書き換えない
+MIGRATIONS = [
+    (1, "基本テーブル (users, units, history, info)", migrate_base_tables),
+    (2, "履歴の全文検索インデックス (FTS5)", migrate_history_fts),
+    (3, "アーカイブ済み履歴の利用回数集計テーブル", migrate_history_usage_stats),
+    (4, "利用記録の重複防止テーブル", migrate_usage_dedup),
+    (5, "拠点間の同期用のテーブル", migrate_federation_tables),
+    (6, "テーブルの変更バージョン (管理画面のキャッシュ用)", migrate_table_versions),
+    (7, "履歴の時刻・子機の接続状態のインデックス", migrate_query_indexes),
+    (8, "イベント時刻の整数カラム (UNIX時刻) とインデックス", migrate_epoch_columns),
+    (9, "使われていない利用回数集計テーブルの削除", drop_history_usage_stats),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
 
-    print("新しいデータベースを作成・初期化します...")
-    with app.app_context():
-        db = get_db()
-        with db:
-            # usersテーブル
-            db.execute('''
-                CREATE TABLE users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    card_id TEXT UNIQUE NOT NULL,
-                    allow INTEGER DEFAULT 1,
-                    entry TEXT,
-                    stock INTEGER DEFAULT 2,
-                    today INTEGER DEFAULT 0,
-                    total INTEGER DEFAULT 0,
-                    last1 TEXT,
-                    last2 TEXT,
-                    last3 TEXT,
-                    last4 TEXT,
-                    last5 TEXT,
-                    last6 TEXT,
-                    last7 TEXT,
-                    last8 TEXT,
-                    last9 TEXT,
-                    last10 TEXT
-                )
-            ''')
-            # unitsテーブル
-            db.execute('''
-                CREATE TABLE units (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT UNIQUE NOT NULL,
-                    password TEXT NOT NULL,
-                    stock INTEGER DEFAULT 0,
-                    connect INTEGER DEFAULT 0,
-                    available INTEGER DEFAULT 1,
-                    last_seen TEXT
-                )
-            ''')
-# --- DBマイグレーション ---
 def migrate_db():
     """
-    データベーススキーマをチェックし、不足しているカラムがあれば追加する。
+    データベースを作成・更新する。未適用のマイグレーションを順に実行し、
+    それぞれの所要時間を表示する。適用したマイグレーションのバージョンのリストを返す。
     """
     print("データベースの構造をチェック・更新します...")
     with app.app_context():
         db = get_db()
-        cursor = db.cursor()
-        # unitsテーブルに 'last_seen' カラムが存在するか確認
-        cursor.execute("PRAGMA table_info(units)")
-        columns = [row['name'] for row in cursor.fetchall()]
-        if 'last_seen' not in columns:
-            print("  -> 更新: unitsテーブルに 'last_seen' カラムを追加します。")
-            try:
-                cursor.execute("ALTER TABLE units ADD COLUMN last_seen TEXT")
-                db.commit()
-                print("  -> 更新完了。")
-            except Exception as e:
-                print(f"  -> エラー: カラムの追加に失敗しました: {e}")
+        # WALモードにして、エクスポートなどの長い読み取り中も子機からの書き込みを止めないようにする
+        journal_mode = db.execute("PRAGMA journal_mode").fetchone()[0]
+        if journal_mode.lower() != 'wal':
+            print("  -> 更新: ジャーナルモードを WAL に変更します。")
+            db.execute("PRAGMA journal_mode=WAL")
+        current = db.execute("PRAGMA user_version").fetchone()[0]
+        if current > SCHEMA_VERSION:
+            raise RuntimeError(
+                f"データベースのバージョン ({current}) がこのアプリ ({SCHEMA_VERSION}) より新しいため起動できません。"
+            )
+        applied = []
+        total_started = time.perf_counter()
+        for version, description, migrate in MIGRATIONS:
+            if version <= current:
+                continue
+            print(f"  -> 更新 v{version}: {description}")
+            started = time.perf_counter()
+            migrate(db)
+            # バージョンは最後に記録する (途中で止まった場合は次回の起動でやり直す)
+            db.execute(f"PRAGMA user_version = {version}")
+            db.commit()
+            print(f"  -> v{version} 完了 ({time.perf_counter() - started:.2f}秒)")
+            applied.append(version)
+        # 動作モードに合わせたトリガーは、モードを切り替えて起動した場合に備えて毎回確認する
+        setup_federation_triggers(db)
+        if applied:
+            print(f"  -> バージョン {current} から {SCHEMA_VERSION} に更新しました ({time.perf_counter() - total_started:.2f}秒)")
         else:
-            print("  -> データベースは最新です。")
+            print(f"  -> データベースは最新です (バージョン {current})。")
+        return applied
+
+def setup_federation_triggers(db):
+    """
+    中央の親機では利用者の変更を user_changes に記録するトリガーを作成し、中央でなくなった親機では削除する。
+    作成・削除した場合は True を返す。
+    """
+    triggers = {row['name'] for row in db.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'user_changes_%'"
+    )}
+    if SITE_MODE == 'central' and not triggers:
+        print("  -> 更新: 利用者の変更を記録するトリガーを作成します。")
+        with db:
+            db.execute("""
+                CREATE TRIGGER user_changes_ai AFTER INSERT ON users BEGIN
+                    INSERT INTO user_changes (card_id) VALUES (new.card_id);
+                END
+            """)
+            db.execute("""
+                CREATE TRIGGER user_changes_au AFTER UPDATE ON users BEGIN
+                    INSERT INTO user_changes (card_id) SELECT old.card_id WHERE old.card_id <> new.card_id;
+                    INSERT INTO user_changes (card_id) VALUES (new.card_id);
+                END
+            """)
+            db.execute("""
+                CREATE TRIGGER user_changes_ad AFTER DELETE ON users BEGIN
+                    INSERT INTO user_changes (card_id) VALUES (old.card_id);
+                END
+            """)
+            # 既存の利用者も全員エッジに配れるよう記録しておく
+            db.execute("INSERT INTO user_changes (card_id) SELECT card_id FROM users ORDER BY id")
+        print("  -> 更新完了。")
+        return True
+    if SITE_MODE != 'central' and triggers:
+        # 中央でなくなった親機では、利用のたびに変更を記録する必要はない
+        print("  -> 更新: 利用者の変更を記録するトリガーを削除します。")
+        with db:
+            for name in triggers:
+                db.execute(f"DROP TRIGGER {name}")
+            db.execute("DELETE FROM user_changes")
+        print("  -> 更新完了。")
+        return True
+    return False
+
+# --- イベント配信 (SSE) ---
+class EventBus:
+    """
+    プロセス内の簡易 pub/sub。書き込み処理が publish したイベントを、
+    SSE で接続中の管理画面それぞれのキューに配る。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.seq = 0
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.discard(q)
+
+    def publish(self, event_type, data):
+        with self.lock:
+            self.seq += 1
+            event = {'id': self.seq, 'type': event_type, 'data': data}
+            subscribers = list(self.subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                pass  # 受け取りが追いつかない接続のイベントは捨てる (画面は再読み込みで復帰できる)
+
+event_bus = EventBus()
+
+def publish_unit(db, unit_id):
+    """子機の最新状態を 'unit' イベントとして配信する"""
+    unit = db.execute(
+        "SELECT id, name, stock, connect, available FROM units WHERE id = ?", (unit_id,)
+    ).fetchone()
+    if unit:
+        event_bus.publish('unit', dict(unit))
+
+# --- 子機の認証トークン ---
+class UnitTokenAuthority:
+    """
+    子機用の署名付きトークンを発行・検証する。検証はメモリ上だけで行い、DBには問い合わせない。
+    鍵はプロセスの起動時に生成し (再起動すると子機はトークンを取り直す)、
+    ローテーション後も直前の鍵で署名されたトークンは有効期限まで受け付ける。
+    失効は子機単位で、トークンに子機ごとの失効回数 (世代) を入れておき、失効させる前の世代のトークンを拒否する。
+    (時刻で比べると、秒単位のタイムスタンプのため失効と同じ秒に取り直したトークンまで拒否してしまう)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = [secrets.token_bytes(32)]
+        self.generations = {}  # 子機ID -> 失効させた回数 (未失効の子機は0)
+        self._refresh_serializer()
+
+    def _refresh_serializer(self):
+        # itsdangerous は鍵のリストの最後で署名し、すべての鍵で検証する
+        self.serializer = URLSafeTimedSerializer(list(self.keys), salt='oiteru-unit-token')
+
+    def issue(self, unit_id, unit_name):
+        """トークンを発行し、(トークン, 有効期間) を返す"""
+        with self.lock:
+            payload = {
+                'uid': unit_id, 'name': unit_name, 'jti': uuid.uuid4().hex,
+                'gen': self.generations.get(unit_id, 0),
+            }
+            return self.serializer.dumps(payload), UNIT_TOKEN_TTL
+
+    def verify(self, token):
+        """トークンが有効なら中身 (uid, name, jti, gen) を、無効なら None を返す"""
+        with self.lock:
+            serializer = self.serializer
+        try:
+            payload = serializer.loads(token, max_age=UNIT_TOKEN_TTL)
+        except (BadSignature, SignatureExpired):
+            return None
+        with self.lock:
+            if payload.get('gen', 0) < self.generations.get(payload.get('uid'), 0):
+                return None
+        return payload
+
+    def rotate(self):
+        """新しい署名鍵に切り替える (古い鍵は UNIT_TOKEN_KEYS_KEPT 個まで検証用に残す)"""
+        with self.lock:
+            self.keys.append(secrets.token_bytes(32))
+            self.keys = self.keys[-UNIT_TOKEN_KEYS_KEPT:]
+            self._refresh_serializer()
+
+    def revoke_unit(self, unit_id):
+        """子機に発行済みのトークンをすべて失効させる"""
+        with self.lock:
+            self.generations[unit_id] = self.generations.get(unit_id, 0) + 1
+
+unit_tokens = UnitTokenAuthority()
+
+def verify_unit_token():
+    """Authorization: Bearer ヘッダーの子機トークンを検証し、中身または None を返す"""
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return None
+    return unit_tokens.verify(header[len('Bearer '):].strip())
 
 # --- ユーティリティ関数 ---
 def add_history(text):
     db = get_db()
-    now = datetime.now().strftime("%Y-%m-%d %H:%M")
-    db.execute("INSERT INTO history (txt) VALUES (?)", (f"{now}: {text}",))
+    now = datetime.now()
+    txt = f"{now.strftime('%Y-%m-%d %H:%M')}: {text}"
+    cursor = db.execute("INSERT INTO history (txt, created_at) VALUES (?, ?)", (txt, int(now.timestamp())))
+    db.commit()
+    event_bus.publish('log', {'id': cursor.lastrowid, 'txt': txt})
+
+def add_history_many(texts):
+    """複数の履歴をまとめて追加する (呼び出し元の書き込みと同じトランザクションでコミットされる)"""
+    db = get_db()
+    now = datetime.now()
+    txts = [f"{now.strftime('%Y-%m-%d %H:%M')}: {text}" for text in texts]
+    db.executemany(
+        "INSERT INTO history (txt, created_at) VALUES (?, ?)", [(txt, int(now.timestamp())) for txt in txts]
+    )
     db.commit()
+    for txt in txts:
+        event_bus.publish('log', {'id': None, 'txt': txt})
+
+def parse_time_arg(value, end=False):
+    """
+    期間指定の値を UNIX時刻 (秒) にする。YYYY-MM-DD、YYYY-MM-DDTHH:MM (YYYY-MM-DD HH:MM)、UNIX時刻の整数を受け付ける。
+    end=True で日付だけが指定された場合は、その日の終わりまで含むよう翌日0時を返す。不正な値は ValueError。
+    """
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    for fmt in ("%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M"):
+        try:
+            return int(datetime.strptime(value, fmt).timestamp())
+        except ValueError:
+            pass
+    try:
+        day = datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"invalid time {value!r} (use YYYY-MM-DD, YYYY-MM-DDTHH:MM or epoch seconds)")
+    return int((day + timedelta(days=1 if end else 0)).timestamp())
+
+def time_range_args():
+    """?from= と ?to= を期間 [開始, 終了) の UNIX時刻にする。指定がなければ None。不正な値は ValueError"""
+    since, until = request.args.get('from', '').strip(), request.args.get('to', '').strip()
+    return (parse_time_arg(since) if since else None,
+            parse_time_arg(until, end=True) if until else None)
+
+def time_range_conditions(column, since=None, until=None):
+    """期間 [since, until) で絞り込む WHERE 句の条件とパラメータのリスト"""
+    conditions, params = [], []
+    if since is not None:
+        conditions.append(f"{column} >= ?")
+        params.append(since)
+    if until is not None:
+        conditions.append(f"{column} < ?")
+        params.append(until)
+    return conditions, params
+
+def mark_timed_out_units(db):
+    """
+    ハートビートが途絶えた子機をオフラインにする。
+    子機クライアント(unit_client.py)は既定で30秒ごとにハートビートを送信するため、
+    送信間隔2回分 (既定65秒) 以上信号がなければオフラインと判断する。
+    """
+    now = time.time()
+    timed_out = []
+    # 現在オンライン(connect=1)になっている子機を取得 (idx_units_connect_last_seen_at)
+    for unit in db.execute("SELECT * FROM units WHERE connect = 1 AND last_seen_at IS NOT NULL").fetchall():
+        # 最終接続時刻からタイムアウト時間を経過しているか確認
+        # (1台の設定が壊れていても他の子機の判定は続ける)
+        try:
+            timeout = unit_heartbeat_timeout(unit).total_seconds()
+        except Exception as e:
+            print(f"!! 子機(ID:{unit['id']})のタイムアウト時間を計算できません: {e}")
+            timeout = unit_heartbeat_timeout({}).total_seconds()
+        if now - unit['last_seen_at'] > timeout:
+            # 画面の表示とバックグラウンドの確認が同時に動いても、オフラインにした側だけが記録する
+            cur = db.execute("UPDATE units SET connect = 0 WHERE id = ? AND connect = 1", (unit['id'],))
+            if cur.rowcount == 1:
+                timed_out.append(unit)
+    db.commit()  # 状態の更新を確定
+    for unit in timed_out:
+        add_history(f"子機がタイムアウトしました: {unit['name']}")
+        publish_unit(db, unit['id'])
+    return timed_out
+
+def unit_timeout_worker():
+    """画面を開いていなくても子機のオフラインを検知できるよう、定期的にタイムアウトを確認する"""
+    while True:
+        try:
+            with app.app_context():
+                mark_timed_out_units(get_db())
+        except Exception as e:
+            print(f"!! 子機のタイムアウト確認中にエラーが発生しました: {e}")
+        time.sleep(UNIT_TIMEOUT_CHECK_INTERVAL)
+
+def history_fts_enabled(db):
+    """履歴の全文検索インデックスが利用できるかどうか"""
+    return db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history_fts'"
+    ).fetchone() is not None
+
+def search_history(db, keyword=None, card_id=None, unit_name=None,
+                   since=None, until=None, page=1, per_page=HISTORY_PAGE_SIZE):
+    """
+    履歴を新しい順に検索する。
+    キーワード・カードID・子機名は全文検索インデックスで絞り込み、期間 [since, until) (UNIX時刻) は
+    created_at のインデックスで絞り込む。(該当行のリスト, 次のページがあるか) を返す。
+    """
+    terms = []
+    if keyword:
+        terms.append(keyword)
+    if card_id:
+        terms.append(card_id)
+    if unit_name:
+        terms.append(f"[{unit_name}]")
+
+    use_fts = history_fts_enabled(db)
+    fts_terms = []
+    conditions = []
+    params = []
+    for term in terms:
+        # trigram は3文字未満の語を検索できないため、その場合は LIKE で絞り込む
+        if use_fts and len(term) >= 3:
+            fts_terms.append('"' + term.replace('"', '""') + '"')
+        else:
+            escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            conditions.append("h.txt LIKE ? ESCAPE '\\'")
+            params.append(f"%{escaped}%")
+    if fts_terms:
+        conditions.insert(0, "h.id IN (SELECT rowid FROM history_fts WHERE history_fts MATCH ?)")
+        params.insert(0, " AND ".join(fts_terms))
+    time_conditions, time_params = time_range_conditions("h.created_at", since, until)
+    conditions.extend(time_conditions)
+    params.extend(time_params)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    offset = (max(page, 1) - 1) * per_page
+    # 1件多く取得して、次のページがあるかを判定する (件数の数え上げは行わない)
+    rows = db.execute(
+        f"SELECT h.id, h.txt FROM history h {where} ORDER BY h.id DESC LIMIT ? OFFSET ?",
+        (*params, per_page + 1, offset)
+    ).fetchall()
+    return rows[:per_page], len(rows) > per_page
+
+def unit_setting_error(key, value):
+    """子機設定の値が不正ならエラーメッセージを、正しければ None を返す"""
+    if key in DEFAULT_UNIT_SETTINGS:
+        # bool は int の一種なので明示的に除く
+        if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+            return f"{key} は正の整数で指定してください。"
+    elif key in UNIT_SETTING_CHOICES:
+        if value not in UNIT_SETTING_CHOICES[key]:
+            return f"{key} は {' / '.join(UNIT_SETTING_CHOICES[key])} のいずれかで指定してください。"
+    elif key == 'use_sensor':
+        if not isinstance(value, bool):
+            return f"{key} は true か false で指定してください。"
+    else:
+        return f"不明な設定キーです: {key}"
+    return None
+
+def load_unit_settings(unit):
+    """子機の設定 (既定値 + units.settings の上書き) を辞書で返す"""
+    settings = dict(DEFAULT_UNIT_SETTINGS)
+    raw = unit['settings'] if 'settings' in unit.keys() else None
+    if raw:
+        try:
+            overrides = json.loads(raw)
+        except ValueError:
+            overrides = {}
+        if isinstance(overrides, dict):
+            # 保存済みの値が不正でも全体が止まらないよう、不正な値は既定値のままにする
+            settings.update({k: v for k, v in overrides.items() if unit_setting_error(k, v) is None})
+    return settings
+
+def build_unit_config(unit):
+    """ハートビートの応答で子機に配信するバージョン付き設定を作る"""
+    return {
+        'version': unit['config_version'] or 1,
+        'available': unit['available'] == 1,
+        'stock': unit['stock'],
+        'settings': load_unit_settings(unit),
+    }
+
+def record_heartbeats(db, beats):
+    """
+    子機のハートビートをまとめて記録する。beats は (子機ID, 子機がキャッシュしている設定のバージョン) のリスト。
+    同じ順番で応答の内容 (子機が見つからなければ None) を返す。
+    """
+    if not beats:
+        return []
+    unit_ids = list({unit_id for unit_id, _ in beats})
+    placeholders = ','.join('?' * len(unit_ids))
+    units = {
+        unit['id']: unit
+        for unit in db.execute(f"SELECT * FROM units WHERE id IN ({placeholders})", unit_ids)
+    }
+    now = datetime.now()
+    now_str = now.strftime("%Y-%m-%d %H:%M:%S")
+
+    # 接続状態と最終接続時刻をまとめて更新
+    db.executemany(
+        "UPDATE units SET connect = 1, last_seen = ?, last_seen_at = ? WHERE id = ?",
+        [(now_str, int(now.timestamp()), unit_id) for unit_id in units]
+    )
+    db.commit()
+    for unit in units.values():
+        if unit['connect'] != 1:
+            # オフラインから復帰した場合のみ配信する (毎回のハートビートでは配信しない)
+            publish_unit(db, unit['id'])
+
+    responses = []
+    for unit_id, client_version in beats:
+        unit = units.get(unit_id)
+        if unit is None:
+            responses.append(None)
+            continue
+        # 子機の設定が古ければ、最新の設定を応答に載せて配信する
+        response = {
+            'success': True,
+            'message': 'Heartbeat received',
+            'config_version': unit['config_version'] or 1,
+        }
+        if client_version != response['config_version']:
+            response['config'] = build_unit_config(unit)
+        responses.append(response)
+    return responses
+
+def unit_heartbeat_timeout(unit):
+    """子機をオフラインと判断するまでの時間 (送信間隔2回分 + 余裕)"""
+    interval = load_unit_settings(unit)['heartbeat_interval']
+    return timedelta(seconds=max(65, int(interval) * 2 + 5))
 
 def check_password(password):
     db = get_db()
@@ -122,6 +901,18 @@ def check_password(password):
 
 
 # ICカードリーダーからカードIDを同期的に読み取る
+def check_reader_connected():
+    """ページ表示時にリーダーの接続を確認する (連続登録モード中は占有しているため、開かずに接続中とする)"""
+    if continuous_enrollment.running:
+        return True
+    try:
+        if nfc is not None:
+            with nfc.ContactlessFrontend('usb'):
+                return True
+    except Exception:
+        pass
+    return False
+
 def read_card_id():
     """
     ICカードリーダーからカードIDを同期的に読み取る。
@@ -132,6 +923,10 @@ def read_card_id():
         if nfc is None:
             flash("サーバー側でNFCライブラリ(nfcpy)が不足しています。", "error")
             return None
+        # 連続登録モード中はリーダーを占有しているため使えない
+        if continuous_enrollment.running:
+            flash("連続登録モード中です。管理画面から連続登録を停止してください。", "warning")
+            return None
 
         # USB接続のリーダーに接続
         with nfc.ContactlessFrontend('usb') as clf:
@@ -161,41 +956,1085 @@ def read_card_id():
         flash(error_message, "error")
         return None
 
+# --- 履歴のアーカイブ ---
+history_maintenance_lock = threading.Lock()
+last_vacuum_at = None
+
+def archive_path(month):
+    """月 (YYYY-MM または unknown) に対応するアーカイブファイルのパス"""
+    return os.path.join(ARCHIVE_DIR, f"history-{month}.csv.gz")
+
+def list_archives():
+    """アーカイブファイルの一覧を新しい月から順に返す"""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    archives = []
+    for filename in sorted(os.listdir(ARCHIVE_DIR), reverse=True):
+        match = re.fullmatch(r'history-(\d{4}-\d{2}|unknown)\.csv\.gz', filename)
+        if match:
+            path = os.path.join(ARCHIVE_DIR, filename)
+            archives.append({'month': match.group(1), 'size': os.path.getsize(path)})
+    return archives
+
+def read_archive(month, keyword=None):
+    """
+    アーカイブファイルの行 (id, txt) を古い順に返す。
+    移動処理の途中で停止した場合は同じ行が重複して書かれることがあるため、idで重複を除く。
+    """
+    path = archive_path(month)
+    if not os.path.exists(path):
+        return []
+    rows = {}
+    with gzip.open(path, 'rt', encoding='utf-8', newline='') as f:
+        for record in csv.reader(f):
+            if len(record) != 2:
+                continue
+            if keyword and keyword not in record[1]:
+                continue
+            rows[int(record[0])] = record[1]
+    return sorted(rows.items())
+
+def archive_history_batch(db, cutoff_date):
+    """
+    cutoff_date (YYYY-MM-DD) より古い履歴を最大 ARCHIVE_BATCH_SIZE 件アーカイブに移す。
+    履歴のIDは時刻順に増えるため、古い順に見て cutoff_date 以降の行が出たら止める。
+    移動した件数を返す。
+    """
+    rows = db.execute(
+        "SELECT id, txt FROM history ORDER BY id LIMIT ?", (ARCHIVE_BATCH_SIZE,)
+    ).fetchall()
+    by_month = {}
+    for row in rows:
+        match = re.match(r'(\d{4}-\d{2})-(\d{2})', row['txt'])
+        if match and f"{match.group(1)}-{match.group(2)}" >= cutoff_date:
+            break
+        month = match.group(1) if match else 'unknown'
+        by_month.setdefault(month, []).append((row['id'], row['txt']))
+    if not by_month:
+        return 0
+
+    # 先にファイルへ書き出してから削除する (途中で止まっても履歴は失われない)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    for month, month_rows in by_month.items():
+        with gzip.open(archive_path(month), 'at', encoding='utf-8', newline='') as f:
+            csv.writer(f).writerows(month_rows)
+
+    archived_ids = [(row_id,) for month_rows in by_month.values() for row_id, _ in month_rows]
+    with db:
+        db.executemany("DELETE FROM history WHERE id = ?", archived_ids)
+    return len(archived_ids)
+
+def maybe_vacuum(db, force=False):
+    """
+    空きページが多くなっていれば VACUUM で領域を回収する。
+    VACUUM は実行中に書き込みを止めるため、強制時以外は VACUUM_HOURS の間に1日1回までとする。
+    実行した場合は True を返す。
+    """
+    global last_vacuum_at
+    now = datetime.now()
+    if not force:
+        if now.hour not in VACUUM_HOURS:
+            return False
+        if last_vacuum_at and now - last_vacuum_at < timedelta(hours=20):
+            return False
+        page_count = db.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = db.execute("PRAGMA freelist_count").fetchone()[0]
+        if page_count == 0 or freelist_count / page_count < VACUUM_FREE_RATIO:
+            return False
+    db.execute("VACUUM")
+    last_vacuum_at = now
+    return True
+
+def run_history_maintenance(force_vacuum=False):
+    """保存期間を過ぎた履歴を少しずつアーカイブし、必要なら VACUUM する"""
+    if not history_maintenance_lock.acquire(blocking=False):
+        return None  # 既に実行中
+    try:
+        with app.app_context():
+            db = get_db()
+            cutoff_date = (datetime.now() - timedelta(days=HISTORY_RETENTION_DAYS)).strftime("%Y-%m-%d")
+            total = 0
+            while True:
+                archived = archive_history_batch(db, cutoff_date)
+                if archived == 0:
+                    break
+                total += archived
+                time.sleep(0.05)  # 子機からの書き込みを待たせないよう、バッチの間で一息つく
+            if total:
+                event_bus.publish('history', {'action': 'archived', 'count': total})
+                add_history(f"履歴アーカイブ: {total}件を移動しました")
+            purge_usage_dedup(db)
+            compact_federation_tables(db)
+            if maybe_vacuum(db, force=force_vacuum):
+                add_history("データベースを最適化しました (VACUUM)")
+            return total
+    except Exception as e:
+        print(f"!! 履歴アーカイブ中にエラーが発生しました: {e}")
+        traceback.print_exc()
+        return None
+    finally:
+        history_maintenance_lock.release()
+
+def history_maintenance_worker():
+    """ARCHIVE_INTERVAL ごとに履歴のアーカイブを実行するバックグラウンドスレッド"""
+    while True:
+        run_history_maintenance()
+        time.sleep(ARCHIVE_INTERVAL)
+
+def start_background_workers():
+    """バックグラウンド処理のスレッドを開始する"""
+    threading.Thread(target=history_maintenance_worker, daemon=True).start()
+    threading.Thread(target=unit_timeout_worker, daemon=True).start()
+    if SITE_MODE == 'edge':
+        threading.Thread(target=federation_sync_worker, daemon=True).start()
+
+# --- 利用状況の集計 ---
+usage_analytics = UsageAnalytics(USAGE_LOG_MARKER)
+
+def iter_archived_usage_logs():
+    """アーカイブ済みの利用ログ (id, txt) を返す"""
+    for archive in list_archives():
+        yield from read_archive(archive['month'], USAGE_LOG_MARKER)
+
+def refresh_usage_analytics(db):
+    """集計エンジンに新しい利用ログを読み込む (初回はアーカイブも読む)"""
+    if usage_analytics.loaded:
+        usage_analytics.refresh(db)
+        return
+    # 初回の読み込み中に履歴がアーカイブへ移ると取りこぼすため、アーカイブ処理と重ならないようにする
+    with history_maintenance_lock:
+        usage_analytics.refresh(db, archived_rows=iter_archived_usage_logs)
+
+def epoch_to_minutes(epoch):
+    """UNIX時刻を集計用の分数 (現地時刻) にする"""
+    return None if epoch is None else to_minutes(datetime.fromtimestamp(epoch))
+
+def time_range_label():
+    """?from= と ?to= の表示名"""
+    return f"{request.args.get('from', '').strip()}〜{request.args.get('to', '').strip()}"
+
+def analytics_period(db, default_days=None):
+    """
+    集計APIの期間指定 (?from=&to=、?days=N または ?month=YYYY-MM) を (開始, 終了, 表示名, 配列) にする。
+    開始・終了は集計用の分数。指定がなければ default_days 日前から、それもなければ今月。
+    from / to を指定した場合だけ、履歴を created_at で絞り込んで読んだ配列を返す (それ以外は None)。
+    from / to が不正な場合は ValueError。
+    """
+    since, until = time_range_args()
+    if since is not None or until is not None:
+        rows = usage_analytics.query(db, since, until)
+        return epoch_to_minutes(since), epoch_to_minutes(until), time_range_label(), rows
+    now = datetime.now()
+    days = request.args.get('days', default_days if 'month' not in request.args else None, type=int)
+    if days and days > 0:
+        return to_minutes(now) - days * MINUTES_PER_DAY, None, f"直近{days}日", None
+    try:
+        start = datetime.strptime(request.args.get('month', ''), "%Y-%m")
+    except ValueError:
+        start = now.replace(day=1, hour=0, minute=0)
+    end = (start + timedelta(days=32)).replace(day=1)
+    return to_minutes(start), to_minutes(end), start.strftime("%Y年%m月"), None
+
+def unit_stock_list(db):
+    """集計用の (子機名, 在庫数) のリスト"""
+    return [(unit['name'], unit['stock']) for unit in db.execute("SELECT name, stock FROM units ORDER BY id")]
+
+# --- カード情報キャッシュ ---
+class CardCache:
+    """
+    カードIDをキーにした利用者情報のLRUキャッシュ。
+    未登録カード (None) もキャッシュするため、利用者を追加・変更・削除したら必ず invalidate する。
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.generation = 0  # 無効化のたびに増える (古い読み取り結果の書き戻しを防ぐ)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, card_id):
+        """(見つかったか, 利用者情報またはNone) を返す"""
+        with self.lock:
+            if card_id in self.entries:
+                self.entries.move_to_end(card_id)
+                self.hits += 1
+                return True, self.entries[card_id]
+            self.misses += 1
+            return False, None
+
+    def put(self, card_id, user, generation):
+        """DBから読んだ利用者情報を登録する。読み取り後に無効化があった場合は登録しない"""
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[card_id] = user
+            self.entries.move_to_end(card_id)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, *card_ids):
+        """指定したカードIDのキャッシュを破棄する"""
+        with self.lock:
+            self.generation += 1
+            for card_id in card_ids:
+                self.entries.pop(card_id, None)
+            self.invalidations += 1
+
+    def clear(self):
+        """キャッシュをすべて破棄する (データ復元時など)"""
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'invalidations': self.invalidations,
+            }
+
+card_cache = CardCache(CARD_CACHE_SIZE)
+
+def lookup_user_by_card(card_id):
+    """カードIDから利用者情報 (dict) を取得する。キャッシュにあればDBへの接続も行わない"""
+    found, user = card_cache.get(card_id)
+    if found:
+        return user
+    generation = card_cache.generation
+    row = get_db().execute('SELECT * FROM users WHERE card_id = ?', (card_id,)).fetchone()
+    user = dict(row) if row else None
+    card_cache.put(card_id, user, generation)
+    return user
+
+# --- 管理画面の表示キャッシュ ---
+class RenderCache:
+    """
+    URLごとに描画済みのHTMLを1つだけ保持するLRUキャッシュ。
+    描画に使ったテーブルの変更バージョンと一緒に保存し、バージョンが変わっていれば使わない。
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # URL -> (バージョン, HTML, 描画にかかった秒数)
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.saved_seconds = 0.0  # キャッシュと304応答で省けた描画時間の合計
+
+    def get(self, path, versions):
+        """同じバージョンで描画したHTMLがあれば返す"""
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != versions:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(path)
+            self.hits += 1
+            self.saved_seconds += entry[2]
+            return entry[1]
+
+    def put(self, path, versions, body, seconds):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[path] = (versions, body, seconds)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def count_not_modified(self, path):
+        """ブラウザのキャッシュが最新だった (304を返した) ことを記録する"""
+        with self.lock:
+            self.not_modified += 1
+            entry = self.entries.get(path)
+            if entry is not None:
+                self.saved_seconds += entry[2]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'not_modified': self.not_modified,
+                'saved_seconds': round(self.saved_seconds, 3),
+            }
+
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+RENDER_CACHE_SALT = secrets.token_hex(8)  # 再起動後は以前の ETag を使わない
+
+def table_versions(db, tables):
+    """指定したテーブルの変更バージョンを (テーブル名, バージョン) のタプルで返す"""
+    placeholders = ', '.join('?' * len(tables))
+    rows = db.execute(
+        f"SELECT name, version FROM table_versions WHERE name IN ({placeholders}) ORDER BY name", tables
+    ).fetchall()
+    return tuple((row['name'], row['version']) for row in rows)
+
+def cached_render(tables, template, build_context):
+    """
+    tables のデータだけから描画するページを、変更バージョンをキーにキャッシュして返す。
+    ETag を付け、ブラウザが同じバージョンを持っていれば (If-None-Match) 304 を返して描画もクエリも省く。
+    build_context はキャッシュがない場合だけ呼ばれ、テンプレートに渡す dict を返す。
+    """
+    if session.get('_flashes'):
+        # フラッシュメッセージはページに埋め込まれて消費されるため、キャッシュしない
+        return render_template(template, **build_context())
+    versions = table_versions(get_db(), tables)
+    path = request.full_path
+    etag = hashlib.sha1(f"{RENDER_CACHE_SALT}:{path}:{versions}".encode()).hexdigest()
+    if etag in request.if_none_match:
+        render_cache.count_not_modified(path)
+        resp = make_response('', 304)
+    else:
+        body = render_cache.get(path, versions)
+        if body is None:
+            started = time.perf_counter()
+            body = render_template(template, **build_context())
+            render_cache.put(path, versions, body, time.perf_counter() - started)
+        resp = make_response(body)
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'private, no-cache'  # 表示のたびにETagで確認してもらう
+    return resp
+
+# --- 一括登録 ---
+def enroll_users(rows):
+    """
+    利用者をまとめて登録する。rows は (行番号などの参照, カードID, 追加カラムのdict) のリスト。
+    既に登録済みのカードや同じバッチ内の重複は登録せず、衝突として返す。
+    1回のトランザクションで登録し、(登録した行, 衝突した行) を返す。
+    """
+    db = get_db()
+    card_ids = list({card_id for _, card_id, _ in rows})
+    existing = set()
+    # SQLiteのパラメータ数上限を超えないよう分割して確認する
+    for i in range(0, len(card_ids), 500):
+        chunk = card_ids[i:i + 500]
+        placeholders = ', '.join('?' * len(chunk))
+        existing.update(
+            row['card_id'] for row in
+            db.execute(f"SELECT card_id FROM users WHERE card_id IN ({placeholders})", chunk)
+        )
+
+    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+    inserted, conflicts, seen = [], [], set()
+    for ref, card_id, fields in rows:
+        if card_id in existing:
+            conflicts.append({'ref': ref, 'card_id': card_id, 'reason': 'already registered'})
+        elif card_id in seen:
+            conflicts.append({'ref': ref, 'card_id': card_id, 'reason': 'duplicate in batch'})
+        else:
+            seen.add(card_id)
+            inserted.append((ref, card_id, {'entry': now, **fields}))
+
+    insert_sql = "INSERT INTO users (card_id, entry, allow, stock) VALUES (?, ?, COALESCE(?, 1), COALESCE(?, 2))"
+    if inserted:
+        try:
+            db.executemany(
+                insert_sql,
+                [(card_id, f['entry'], f.get('allow'), f.get('stock')) for _, card_id, f in inserted]
+            )
+        except sqlite3.IntegrityError:
+            # 確認の後に別の処理が同じカードを登録した場合は、1件ずつ登録して衝突した行を特定する
+            db.rollback()
+            rows_to_retry, inserted = inserted, []
+            for ref, card_id, f in rows_to_retry:
+                try:
+                    db.execute(insert_sql, (card_id, f['entry'], f.get('allow'), f.get('stock')))
+                    inserted.append((ref, card_id, f))
+                except sqlite3.IntegrityError:
+                    conflicts.append({'ref': ref, 'card_id': card_id, 'reason': 'already registered'})
+    if inserted:
+        for _, card_id, f in inserted:
+            federation_enqueue(db, 'register', card_id, {
+                'entry': f['entry'], 'allow': f.get('allow'), 'stock': f.get('stock')
+            })
+        add_history_many([f"新規登録({card_id})" for _, card_id, _ in inserted])  # ここでまとめてコミット
+        card_cache.invalidate(*[card_id for _, card_id, _ in inserted])
+        event_bus.publish('user', {'action': 'added', 'count': len(inserted)})
+    return inserted, conflicts
+
+def parse_bulk_row(record):
+    """一括インポートの1行 (dict) を (カードID, 追加カラム) に変換する。不正な場合は ValueError"""
+    card_id = str(record.get('card_id') or '').strip()
+    if not card_id:
+        raise ValueError('card_id is required')
+    fields = {}
+    for key in ('allow', 'stock'):
+        value = record.get(key)
+        if value not in (None, ''):
+            fields[key] = int(value)
+    entry = record.get('entry')
+    if entry:
+        fields['entry'] = str(entry)
+    return card_id, fields
+
+def iter_bulk_records(stream, content_type):
+    """リクエスト本文を1行ずつ読み、(行番号, dict または ValueError) を順に返す"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if 'csv' in content_type:
+        for record in csv.DictReader(text):
+            yield record, None
+    elif 'ndjson' in content_type or 'jsonl' in content_type:
+        for line in text:
+            if line.strip():
+                try:
+                    yield json.loads(line), None
+                except ValueError as e:
+                    yield None, e
+    else:
+        # 通常のJSON配列は全体を読み込んでから処理する
+        try:
+            records = json.load(text)
+        except ValueError as e:
+            yield None, e
+            return
+        if not isinstance(records, list):
+            yield None, ValueError('JSON body must be an array')
+            return
+        for record in records:
+            yield record, None
+
+class ContinuousEnrollment:
+    """
+    連続登録モード。リーダーでカードを読み続け、読み取ったカードを
+    ENROLL_BATCH_SIZE 件または ENROLL_FLUSH_INTERVAL 秒ごとにまとめて登録する。
+    結果は feed に溜め、管理画面がそれを順次表示する。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.feed = deque(maxlen=ENROLL_FEED_SIZE)
+        self.seq = 0
+        self.stats = {'registered': 0, 'duplicate': 0, 'error': 0}
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """連続登録を開始する。既に実行中なら False を返す"""
+        with self.lock:
+            if self.running:
+                return False
+            self.stop_event.clear()
+            self.stats = {'registered': 0, 'duplicate': 0, 'error': 0}
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        self.stop_event.set()
+
+    def events_after(self, seq):
+        """seq より後の結果を返す"""
+        with self.lock:
+            return [event for event in self.feed if event['seq'] > seq]
+
+    def _emit(self, status, message, card_id=None):
+        with self.lock:
+            self.seq += 1
+            if status in self.stats:
+                self.stats[status] += 1
+            self.feed.append({
+                'seq': self.seq,
+                'time': datetime.now().strftime("%H:%M:%S"),
+                'status': status,
+                'card_id': card_id,
+                'message': message,
+            })
+
+    def _flush(self, pending):
+        if not pending:
+            return
+        try:
+            with app.app_context():
+                inserted, conflicts = enroll_users([(card_id, card_id, {}) for card_id in pending])
+            for _, card_id, _ in inserted:
+                self._emit('registered', '登録しました', card_id)
+            for conflict in conflicts:
+                self._emit('duplicate', '登録済みのカードです', conflict['card_id'])
+        except Exception as e:
+            for card_id in pending:
+                self._emit('error', f'登録に失敗しました: {e}', card_id)
+        pending.clear()
+
+    def _run(self):
+        if nfc is None:
+            self._emit('error', 'サーバー側でNFCライブラリ(nfcpy)が不足しています。')
+            return
+        pending = []
+        last_read = {}
+        last_flush = time.monotonic()
+        try:
+            with nfc.ContactlessFrontend('usb') as clf:
+                self._emit('info', '連続登録を開始しました。カードを順にかざしてください。')
+                while not self.stop_event.is_set():
+                    target = clf.sense(
+                        nfc.clf.RemoteTarget('106A'), nfc.clf.RemoteTarget('106B'),
+                        nfc.clf.RemoteTarget('212F'), iterations=1, interval=0.2
+                    )
+                    now = time.monotonic()
+                    if target is not None:
+                        tag = nfc.tag.activate(clf, target)
+                        card_id = tag.idm.hex() if hasattr(tag, 'idm') else None
+                        # 置いたままのカードを何度も登録しないよう、一定時間は読み飛ばす
+                        if card_id and now - last_read.get(card_id, 0) > ENROLL_DEBOUNCE_SECONDS:
+                            pending.append(card_id)
+                        if card_id:
+                            last_read[card_id] = now
+                    if len(pending) >= ENROLL_BATCH_SIZE or (pending and now - last_flush >= ENROLL_FLUSH_INTERVAL):
+                        self._flush(pending)
+                        last_flush = now
+        except IOError:
+            self._emit('error', 'ICカードリーダーが見つかりません。USB接続を確認してください。')
+        except Exception as e:
+            traceback.print_exc()
+            self._emit('error', f'NFCリーダーで予期せぬエラーが発生しました: {e}')
+        finally:
+            self._flush(pending)
+            self._emit('info', '連続登録を終了しました。')
+
+continuous_enrollment = ContinuousEnrollment()
+
+# --- バックグラウンドジョブ ---
+class JobRunner:
+    """
+    バックアップ・復元・エクスポートなどの重い処理を、リクエストとは別のスレッドで実行する。
+    ジョブの状態はメモリ上に持ち、成果物は JOB_DIR にファイルとして保存する。
+    状態が変わるたびに 'job' イベントを配信する。
+    """
+
+    def __init__(self, max_workers):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='oiteru-job')
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+
+    def submit(self, kind, label, func, *args, key=None):
+        """
+        ジョブを登録し、(ジョブ, 新しく登録したかどうか) を返す。
+        同じジョブ (key。省略時は種類) が待機中・実行中ならそれを返し、上限を超える場合のジョブは None になる。
+        """
+        key = key if key is not None else kind
+        self.prune()
+        with self.lock:
+            active = [job for job in self.jobs.values() if job['status'] in ('queued', 'running')]
+            for job in active:
+                if job['key'] == key:
+                    return job, False
+            if len(active) >= JOB_MAX_PENDING:
+                return None, False
+            job = {
+                'id': uuid.uuid4().hex,
+                'kind': kind,
+                'key': key,
+                'label': label,
+                'status': 'queued',
+                'progress': 0,
+                'message': '待機中',
+                'created': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                'finished': None,
+                'error': None,
+                'artifact': None,
+                'download_name': None,
+                'mimetype': None,
+            }
+            self.jobs[job['id']] = job
+        self._publish(job)
+        self.executor.submit(self._run, job, func, args)
+        return job, True
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list(self):
+        with self.lock:
+            return [dict(job) for job in reversed(self.jobs.values())]
+
+    def update(self, job, progress=None, message=None):
+        """ジョブの進捗 (0-100) とメッセージを更新する"""
+        with self.lock:
+            if progress is not None:
+                job['progress'] = int(progress)
+            if message is not None:
+                job['message'] = message
+        self._publish(job)
+
+    def prune(self):
+        """保存期間を過ぎたジョブと成果物を削除する"""
+        limit = (datetime.now() - timedelta(hours=JOB_RETENTION_HOURS)).strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            expired = [job for job in self.jobs.values() if job['finished'] and job['finished'] < limit]
+            for job in expired:
+                del self.jobs[job['id']]
+        for job in expired:
+            if job['artifact'] and os.path.exists(job['artifact']):
+                os.remove(job['artifact'])
+
+    def _publish(self, job):
+        event_bus.publish('job', public_job(job))
+
+    def _run(self, job, func, args):
+        with self.lock:
+            job['status'] = 'running'
+        self.update(job, progress=0, message='実行中')
+        try:
+            with app.app_context():
+                artifact = func(job, *args)
+            with self.lock:
+                if artifact:
+                    job['artifact'], job['download_name'], job['mimetype'] = artifact
+                job['status'] = 'done'
+                job['progress'] = 100
+                job['message'] = '完了'
+        except Exception as e:
+            traceback.print_exc()
+            with self.lock:
+                job['status'] = 'failed'
+                job['error'] = str(e)
+                job['message'] = f'失敗: {e}'
+        finally:
+            with self.lock:
+                job['finished'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self._publish(job)
+
+job_runner = JobRunner(JOB_MAX_WORKERS)
+
+def public_job(job):
+    """画面・APIに返すジョブ情報 (成果物のパスと重複判定用のキーは含めない)"""
+    info = {key: value for key, value in job.items() if key not in ('artifact', 'key')}
+    info['downloadable'] = bool(job.get('artifact'))
+    return info
+
+def job_artifact_path(job, extension):
+    os.makedirs(JOB_DIR, exist_ok=True)
+    return os.path.join(JOB_DIR, f"{job['id']}{extension}")
+
+def iter_history(db, like=None, since=None, until=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    履歴を古い順に少しずつ読み出す。1回の読み取りを短くして、書き込みを待たせないようにする。
+    期間 [since, until) (UNIX時刻) を指定した場合は、その期間のIDの範囲だけを読む。
+    (読み出した行, 進捗率) を返す。
+    """
+    first_id, max_id = history_id_range(db, since, until)
+    last_id = first_id - 1
+    conditions, params = time_range_conditions("created_at", since, until)
+    if like:
+        conditions.append("txt LIKE ?")
+        params.append(like)
+    extra = ''.join(f" AND {condition}" for condition in conditions)
+    while last_id < max_id:
+        rows = db.execute(
+            f"SELECT id, txt FROM history WHERE id > ? AND id <= ?{extra} ORDER BY id LIMIT ?",
+            (last_id, max_id, *params, batch_size)
+        ).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1]['id']
+        yield rows, (last_id - first_id + 1) * 100 / (max_id - first_id + 1)
+
+def history_id_range(db, since=None, until=None):
+    """期間 [since, until) の履歴の (最小ID, 最大ID)。created_at のインデックスだけで求める"""
+    conditions, params = time_range_conditions("created_at", since, until)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    row = db.execute(f"SELECT MIN(id), MAX(id) FROM history {where}", params).fetchone()
+    return row[0] or 0, row[1] or 0
+
+def backup_job(job):
+    """利用者データをExcel形式で書き出す"""
+    db = get_db()
+    users_list = [dict(row) for row in db.execute("SELECT * FROM users ORDER BY id")]
+    if not users_list:
+        raise ValueError("バックアップ対象のユーザーデータがありません。")
+    job_runner.update(job, progress=30, message=f"{len(users_list)}件をExcelに書き出し中")
+    df = pd.DataFrame(users_list)
+    path = job_artifact_path(job, '.xlsx')
+    with pd.ExcelWriter(path, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name='users')
+    add_history("データバックアップ作成")
+    filename = f"backup_users_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+    return path, filename, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+def restore_job(job, upload_path):
+    """アップロードされたExcelファイルから利用者データを復元する"""
+    try:
+        df = pd.read_excel(upload_path)
+        required_columns = ['card_id', 'allow', 'entry', 'stock', 'today', 'total']
+        if not all(col in df.columns for col in required_columns):
+            raise ValueError('Excelファイルの形式が正しくありません。必須カラムが不足しています。')
+        job_runner.update(job, progress=50, message=f"{len(df)}件を書き込み中")
+        db = get_db()
+        with db:
+            db.execute("DELETE FROM users")
+            df.to_sql('users', db, if_exists='append', index=False)
+        card_cache.clear()
+        event_bus.publish('user', {'action': 'restored', 'count': len(df)})
+        add_history("データ復元完了")
+    except Exception as e:
+        add_history(f"データ復元エラー: {e}")
+        raise
+    finally:
+        os.remove(upload_path)
+
+def usage_csv_job(job, since=None, until=None):
+    """利用履歴 (利用を記録しました のログ) をCSVに書き出す。期間 [since, until) を指定できる"""
+    db = get_db()
+    path = job_artifact_path(job, '.csv')
+    count = 0
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['timestamp', 'card_id'])
+        for rows, progress in iter_history(db, like=f"%{USAGE_LOG_MARKER}%", since=since, until=until):
+            for row in rows:
+                match = re.search(r'\((\w+)\)', row['txt'])
+                writer.writerow([row['txt'][:16], match.group(1) if match else '不明'])
+            count += len(rows)
+            job_runner.update(job, progress=progress, message=f"{count}件を書き出し中")
+    if count == 0:
+        os.remove(path)
+        raise ValueError("ダウンロード対象の利用履歴がありません。")
+    return path, 'usage_history.csv', 'text/csv'
+
+def log_export_job(job, since=None, until=None):
+    """全ての履歴ログをCSVに書き出す。期間 [since, until) を指定できる"""
+    db = get_db()
+    path = job_artifact_path(job, '.csv')
+    count = 0
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['log'])
+        for rows, progress in iter_history(db, since=since, until=until):
+            writer.writerows([row['txt']] for row in rows)
+            count += len(rows)
+            job_runner.update(job, progress=progress, message=f"{count}件を書き出し中")
+    if count == 0:
+        os.remove(path)
+        raise ValueError("ダウンロード対象のログがありません。")
+    return path, 'all_history_logs.csv', 'text/csv'
+
+def submit_admin_job(kind, label, func, *args, key=None, discard=None):
+    """
+    管理画面からジョブを登録し、ジョブ一覧へ移動する。
+    discard には、新しいジョブとして登録されなかった場合に削除するファイル (アップロードされたファイルなど) を指定する。
+    """
+    job, created = job_runner.submit(kind, label, func, *args, key=key)
+    if not created and discard and os.path.exists(discard):
+        os.remove(discard)
+    if job is None:
+        flash("実行待ちのジョブが多すぎます。しばらくしてからもう一度お試しください。", "warning")
+    else:
+        flash(f"「{job['label']}」をバックグラウンドで実行しています。完了したらこの画面からダウンロードできます。", "success")
+    return redirect(url_for('admin_jobs'))
+
+# --- 利用記録 ---
+def apply_usage(db, unit_id, card_id):
+    """
+    利用を1回分記録する (コミットは呼び出し側で行う)。
+    (HTTPステータス, 応答, 子機の行, 配信するイベント) を返す。記録しなかった場合のイベントは None。
+    """
+    user = db.execute("SELECT * FROM users WHERE card_id = ?", (card_id,)).fetchone()
+    if not user:
+        return 404, {'error': 'User not found'}, None, None
+    if user['stock'] <= 0:
+        return 400, {'error': 'No stock remaining'}, None, None
+    # 子機の利用可否と在庫も確認する
+    unit = db.execute("SELECT * FROM units WHERE id = ?", (unit_id,)).fetchone()
+    if unit is not None:
+        if unit['available'] != 1:
+            return 400, {'error': 'Unit is not available'}, unit, None
+        if unit['stock'] <= 0:
+            return 400, {'error': 'Unit out of stock', 'unit_stock': unit['stock']}, unit, None
+    now = int(time.time())
+    values = usage_update(user, now)
+    update_user_columns(db, card_id, values)
+    federation_enqueue(db, 'usage', card_id, {
+        'at': now, 'unit': unit['name'] if unit is not None else None
+    })
+    response = {'success': True, 'message': 'Usage recorded successfully.'}
+    if unit is not None:
+        # 子機の在庫も減らし、子機側のキャッシュと同期できるよう新しい在庫数を返す
+        db.execute("UPDATE units SET stock = stock - 1 WHERE id = ?", (unit['id'],))
+        response['unit_stock'] = unit['stock'] - 1
+    event = {
+        'card_id': card_id,
+        'unit_name': unit['name'] if unit is not None else None,
+        'user_stock': values['stock'],
+        'time': values['last1'],
+    }
+    return 200, response, unit, event
+
+def usage_update(user, at):
+    """
+    利用1回分で変わる利用者のカラムと値を返す (在庫を減らし、利用回数を増やし、利用日時の履歴をずらす)。
+    at は利用した時刻 (UNIX時刻)。
+    """
+    values = {'stock': user['stock'] - 1, 'total': user['total'] + 1, 'today': user['today'] + 1}
+    values.update({f"last{i+1}": user[f"last{i}"] for i in range(1, 10)})
+    values['last1'] = datetime.fromtimestamp(at).strftime("%Y-%m-%d %H:%M:%S")
+    values['last_used_at'] = at
+    return values
+
+def update_user_columns(db, card_id, values):
+    """カードIDの利用者の指定したカラムを更新する"""
+    set_clauses = ', '.join(f"{key} = ?" for key in values)
+    db.execute(f"UPDATE users SET {set_clauses} WHERE card_id = ?", (*values.values(), card_id))
+
+def purge_usage_dedup(db):
+    """保存期間を過ぎたタップIDを削除する"""
+    cutoff = int(time.time()) - USAGE_DEDUP_TTL_HOURS * 3600
+    deleted = db.execute("DELETE FROM usage_dedup WHERE created_at < ?", (cutoff,)).rowcount
+    db.commit()
+    return deleted
+
+# --- 拠点間の同期 ---
+# エッジは利用記録と利用者の変更を federation_outbox に溜めて中央へ送り、中央で変わった利用者の行を取り込む。
+# 利用は「在庫を1減らす」差分として送り、中央の最新の行に重ねて反映するため、
+# 複数のエッジで同じ利用者が利用しても回数は失われない (在庫が足りなければ0で止め、競合として履歴に残す)。
+federation_status = {'last_sync': None, 'last_error': None, 'pushed': 0, 'pulled': 0}
+
+def federation_enqueue(db, kind, card_id, payload):
+    """エッジの場合、中央へ送るイベントを追加する (コミットは呼び出し側で行う)"""
+    if SITE_MODE != 'edge':
+        return
+    db.execute(
+        "INSERT INTO federation_outbox (event_id, kind, card_id, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+        (uuid.uuid4().hex, kind, card_id, json.dumps(payload, ensure_ascii=False),
+         datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    )
+
+def verify_federation_key():
+    """拠点間の同期APIの共有鍵 (X-Federation-Key ヘッダー) を確認する"""
+    key = request.headers.get('X-Federation-Key', '')
+    return bool(FEDERATION_KEY) and hmac.compare_digest(key.encode(), FEDERATION_KEY.encode())
+
+def touch_user_change(db, *card_ids):
+    """中央の利用者の行をエッジに送り直す (エッジの変更を反映できなかった場合など)"""
+    db.executemany("INSERT INTO user_changes (card_id) VALUES (?)", [(c,) for c in card_ids if c])
+
+def apply_federation_event(db, site, event):
+    """
+    エッジから届いたイベントを中央のDBに1件反映する (コミットは呼び出し側で行う)。
+    履歴に追加する (UNIX時刻, 行) のリストを返す。反映済みのイベントは何もしない。
+    """
+    applied = db.execute(
+        "INSERT OR IGNORE INTO federation_applied (site, event_id, applied_at) VALUES (?, ?, ?)",
+        (site, event['id'], int(time.time()))
+    ).rowcount
+    if not applied:
+        return []  # 再送されたイベント
+    kind, card_id = event['kind'], event['card_id']
+    payload = event.get('payload') or {}
+    now_at = int(time.time())
+    now = datetime.fromtimestamp(now_at).strftime("%Y-%m-%d %H:%M")
+    source = f"{site}/{payload['unit']}" if payload.get('unit') else site
+    user = db.execute("SELECT * FROM users WHERE card_id = ?", (card_id,)).fetchone()
+
+    if kind == 'usage':
+        at = int(payload.get('at') or now_at)
+        if user is None:
+            return [(now_at, f"{now}: [{source}] 同期エラー: 未登録のカードの利用を受け取りました ({card_id})")]
+        values = usage_update(user, at)
+        lines = [(at, f"{values['last1'][:16]}: [{source}] {USAGE_LOG_MARKER} ({card_id})")]
+        if values['stock'] < 0:
+            # 同期前に別の拠点でも利用されていた。在庫は0で止めて記録を残す
+            values['stock'] = 0
+            lines.append((now_at, f"{now}: [{source}] 在庫の競合: 在庫0の利用者の利用を受け取りました ({card_id})"))
+        update_user_columns(db, card_id, values)
+        return lines
+    if kind == 'register':
+        inserted = db.execute(
+            "INSERT OR IGNORE INTO users (card_id, entry, allow, stock) VALUES (?, ?, COALESCE(?, 1), COALESCE(?, 2))",
+            (card_id, payload.get('entry') or now, payload.get('allow'), payload.get('stock'))
+        ).rowcount
+        if not inserted:
+            touch_user_change(db, card_id)  # 中央の行でエッジの登録内容を上書きしてもらう
+            return [(now_at, f"{now}: [{site}] 同期: 登録済みのカードのため中央の情報を使います ({card_id})")]
+        return [(now_at, f"{now}: [{site}] 新規登録({card_id})")]
+    if kind == 'update':
+        new_card_id = payload.get('card_id') or card_id
+        if user is None:
+            touch_user_change(db, card_id, new_card_id)
+            return [(now_at, f"{now}: [{site}] 同期エラー: 更新する利用者が見つかりません ({card_id})")]
+        try:
+            db.execute(
+                "UPDATE users SET card_id = ?, allow = ?, stock = ? WHERE card_id = ?",
+                (new_card_id, payload.get('allow', user['allow']), payload.get('stock', user['stock']), card_id)
+            )
+        except sqlite3.IntegrityError:
+            touch_user_change(db, card_id, new_card_id)
+            return [(now_at, f"{now}: [{site}] 同期エラー: カードID {new_card_id} は既に登録されています")]
+        return [(now_at, f"{now}: [{site}] 利用者更新({card_id})")]
+    if kind == 'delete':
+        db.execute("DELETE FROM users WHERE card_id = ?", (card_id,))
+        return [(now_at, f"{now}: [{site}] 利用者削除({card_id})")]
+    return [(now_at, f"{now}: [{site}] 同期エラー: 不明なイベント '{kind}' ({card_id})")]
+
+def federation_request(method, path, **kwargs):
+    """中央の親機の同期APIを呼び出し、JSONの応答を返す"""
+    if not CENTRAL_URL:
+        raise RuntimeError('OITERU_CENTRAL_URL が設定されていません')
+    resp = requests.request(
+        method, CENTRAL_URL + path, headers={'X-Federation-Key': FEDERATION_KEY},
+        timeout=FEDERATION_TIMEOUT, **kwargs
+    )
+    resp.raise_for_status()
+    return resp.json()
+
+def push_federation_outbox(db):
+    """溜まっているイベントを古い順に中央へ送り、受け取られたものを削除する。送った件数を返す"""
+    total = 0
+    while True:
+        rows = db.execute(
+            "SELECT event_id, kind, card_id, payload FROM federation_outbox ORDER BY id LIMIT ?",
+            (FEDERATION_BATCH_SIZE,)
+        ).fetchall()
+        if not rows:
+            return total
+        result = federation_request('POST', '/api/federation/events', json={
+            'site': SITE_NAME,
+            'events': [
+                {'id': row['event_id'], 'kind': row['kind'], 'card_id': row['card_id'],
+                 'payload': json.loads(row['payload'])}
+                for row in rows
+            ],
+        })
+        acked = result.get('acked') or []
+        db.executemany("DELETE FROM federation_outbox WHERE event_id = ?", [(event_id,) for event_id in acked])
+        db.commit()
+        total += len(acked)
+        if len(acked) < len(rows):
+            return total  # 残りは次回の同期で送り直す
+
+def apply_central_changes(db, changes):
+    """
+    中央から取り込んだ利用者の行をエッジのDBに反映する (コミットは呼び出し側で行う)。
+    まだ中央に送れていない利用は中央の行に重ねて適用し、管理者の変更が未送信のカードはそのまま残す
+    (送信後に中央で変わった行が改めて届く)。反映したカードIDのリストを返す。
+    """
+    pending_usage, held = {}, set()
+    for row in db.execute("SELECT kind, card_id, payload FROM federation_outbox ORDER BY id"):
+        payload = json.loads(row['payload'])
+        if row['kind'] == 'usage':
+            pending_usage.setdefault(row['card_id'], []).append(payload.get('at'))
+        else:
+            held.update([row['card_id'], payload.get('card_id')])
+    columns = [row['name'] for row in db.execute("PRAGMA table_info(users)") if row['name'] != 'id']
+
+    changed = []
+    for change in changes:
+        card_id = change['card_id']
+        if card_id in held:
+            continue
+        if change.get('deleted'):
+            db.execute("DELETE FROM users WHERE card_id = ?", (card_id,))
+        else:
+            values = {key: change['user'].get(key) for key in columns}
+            for at in pending_usage.get(card_id, []):
+                values.update(usage_update(values, at))
+                values['stock'] = max(values['stock'], 0)
+            updates = ', '.join(f"{key} = excluded.{key}" for key in columns if key != 'card_id')
+            db.execute(
+                f"INSERT INTO users ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT(card_id) DO UPDATE SET {updates}",
+                [values[key] for key in columns]
+            )
+        changed.append(card_id)
+    return changed
+
+def pull_federation_changes(db):
+    """前回の続きから中央の利用者の変更を取り込む。反映した件数を返す"""
+    row = db.execute("SELECT value FROM federation_state WHERE key = 'cursor'").fetchone()
+    cursor = int(row['value']) if row else 0
+    total = 0
+    while True:
+        result = federation_request('GET', '/api/federation/changes', params={
+            'since': cursor, 'limit': FEDERATION_BATCH_SIZE
+        })
+        if result['changes']:
+            # 未送信の利用を確認してから反映し終えるまで、子機からの書き込みを待たせる
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                changed = apply_central_changes(db, result['changes'])
+                db.execute(
+                    "INSERT OR REPLACE INTO federation_state (key, value) VALUES ('cursor', ?)",
+                    (str(result['cursor']),)
+                )
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            card_cache.invalidate(*changed)
+            total += len(changed)
+        cursor = result['cursor']
+        if not result.get('more'):
+            return total
+
+def federation_sync_once():
+    """エッジのイベントを中央へ送り、中央の変更を取り込む"""
+    with app.app_context():
+        db = get_db()
+        pushed = push_federation_outbox(db)
+        pulled = pull_federation_changes(db)
+    federation_status.update(
+        last_sync=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), last_error=None,
+        pushed=federation_status['pushed'] + pushed, pulled=federation_status['pulled'] + pulled,
+    )
+    if pulled:
+        event_bus.publish('user', {'action': 'synced', 'count': pulled})
+    return pushed, pulled
+
+def federation_sync_worker():
+    """FEDERATION_SYNC_INTERVAL ごとに中央と同期するバックグラウンドスレッド (失敗したら間隔を延ばす)"""
+    delay = FEDERATION_SYNC_INTERVAL
+    while True:
+        try:
+            federation_sync_once()
+            delay = FEDERATION_SYNC_INTERVAL
+        except Exception as e:
+            federation_status['last_error'] = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: {e}"
+            print(f"!! 中央の親機との同期に失敗しました: {e}")
+            delay = min(delay * 2, FEDERATION_MAX_BACKOFF)
+        time.sleep(delay)
+
+def compact_federation_tables(db):
+    """中央の変更記録をカードごとの最新だけにし、古い反映済みイベントIDを削除する"""
+    db.execute(
+        "DELETE FROM user_changes WHERE seq NOT IN (SELECT MAX(seq) FROM user_changes GROUP BY card_id)"
+    )
+    cutoff = int(time.time()) - FEDERATION_APPLIED_TTL_DAYS * 24 * 3600
+    db.execute("DELETE FROM federation_applied WHERE applied_at < ?", (cutoff,))
+    db.commit()
+
+
 # --- UIルート ---
 
 # ↓↓↓↓ ここから貼り付け ↓↓↓↓
 
 @app.route("/admin/backup/download")
 def admin_backup_download():
-    """管理者向けにユーザーデータをExcel形式でダウンロードさせる"""
+    """管理者向けにユーザーデータをExcel形式で作成する (バックグラウンドジョブ)"""
     if not session.get("admin_logged_in"):
         return redirect(url_for("admin_login"))
-    db = get_db()
-    try:
-        # データベースから全ユーザー情報を取得
-        users_cursor = db.execute("SELECT * FROM users ORDER BY id")
-        users = users_cursor.fetchall()
-        users_list = [dict(row) for row in users]
-        if not users_list:
-            flash("バックアップ対象のユーザーデータがありません。", "warning")
-            return redirect(url_for('admin_dashboard'))
-        df = pd.DataFrame(users_list)
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='users')
-        output.seek(0)
-        filename = f"backup_users_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        add_history("データバックアップ作成")
-        return send_file(
-            output,
-            as_attachment=True,
-            download_name=filename,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
-    except Exception as e:
-        flash(f"バックアップファイルの作成中にエラーが発生しました: {e}", "error")
-        add_history(f"バックアップ作成失敗: {e}")
-        return redirect(url_for('admin_dashboard'))
+    return submit_admin_job('backup', 'データバックアップ', backup_job)
 
 @app.route('/admin/restore', methods=['GET', 'POST'])
 def admin_restore():
@@ -204,6 +2043,10 @@ def admin_restore():
         return redirect(url_for('admin_login'))
 
     if request.method == 'POST':
+        if SITE_MODE == 'edge':
+            # エッジで復元しても中央の情報で上書きされるため、中央の親機で行う
+            flash('エッジの親機では復元できません。中央の親機で復元してください。', 'warning')
+            return redirect(request.url)
         if 'backup_file' not in request.files:
             flash('ファイルが選択されていません。', 'error')
             return redirect(request.url)
@@ -212,23 +2055,11 @@ def admin_restore():
             flash('ファイルが選択されていません。', 'error')
             return redirect(request.url)
         if file and file.filename.endswith('.xlsx'):
-            try:
-                df = pd.read_excel(file)
-                required_columns = ['card_id', 'allow', 'entry', 'stock', 'today', 'total']
-                if not all(col in df.columns for col in required_columns):
-                    flash('Excelファイルの形式が正しくありません。必須カラムが不足しています。', 'error')
-                    return redirect(request.url)
-                db = get_db()
-                with db:
-                    db.execute("DELETE FROM users")
-                    df.to_sql('users', db, if_exists='append', index=False)
-                add_history("データ復元完了")
-                flash('データベースの復元が正常に完了しました。', 'success')
-                return redirect(url_for('admin_users'))
-            except Exception as e:
-                add_history(f"データ復元エラー: {e}")
-                flash(f'ファイルの処理中にエラーが発生しました: {e}', 'error')
-                return redirect(request.url)
+            # アップロードされたファイルを保存し、復元はバックグラウンドジョブで行う
+            os.makedirs(JOB_DIR, exist_ok=True)
+            upload_path = os.path.join(JOB_DIR, f"upload_{uuid.uuid4().hex}.xlsx")
+            file.save(upload_path)
+            return submit_admin_job('restore', 'データ復元', restore_job, upload_path, discard=upload_path)
         else:
             flash('許可されていないファイル形式です。.xlsxファイルをアップロードしてください。', 'warning')
             return redirect(request.url)
@@ -243,100 +2074,112 @@ def admin_visuals():
         return redirect(url_for('admin_login'))
 
     db = get_db()
-    # 履歴から「利用を記録しました」というログのみを抽出
-    logs = db.execute("SELECT txt FROM history WHERE txt LIKE '%利用を記録しました%'").fetchall()
-
-    timestamps = []
-    for log in logs:
-        timestamp_str = log['txt'][:16]
-        try:
-            dt = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M")
-            timestamps.append(dt)
-        except (ValueError, TypeError):
-            continue
-
-    hourly_counts = [0] * 24
-    daily_counts = {}
-    weekly_counts = [0] * 7
-    for ts in timestamps:
-        hourly_counts[ts.hour] += 1
-        day_str = ts.strftime("%Y-%m-%d")
-        daily_counts[day_str] = daily_counts.get(day_str, 0) + 1
-        weekly_counts[ts.weekday()] += 1
-    sorted_daily = sorted(daily_counts.items())
-    daily_labels = [item[0] for item in sorted_daily]
-    daily_values = [item[1] for item in sorted_daily]
+    refresh_usage_analytics(db)
+    now = datetime.now()
+    # ?from=&to= を指定した場合は、グラフ・利用者・ヒートマップをその期間で集計する
+    try:
+        since, until = time_range_args()
+    except ValueError:
+        flash("期間は YYYY-MM-DD の形式で指定してください。", "error")
+        since = until = None
+    if since is not None or until is not None:
+        # 期間の指定は created_at のインデックスで履歴を絞り込んで集計する
+        period = time_range_label()
+        rows = usage_analytics.query(db, since, until)
+        user_range = heatmap_range = (None, None)
+        user_period = heatmap_period = period
+    else:
+        period = rows = None
+        user_range = (to_minutes(now.replace(day=1, hour=0, minute=0)), None)
+        heatmap_range = (to_minutes(now) - ANALYTICS_HEATMAP_DAYS * MINUTES_PER_DAY, None)
+        user_period, heatmap_period = "今月", f"直近{ANALYTICS_HEATMAP_DAYS}日"
+    totals = usage_analytics.totals(rows=rows)
     chart_data = {
         'hourly_labels': [f"{h:02d}:00" for h in range(24)],
-        'hourly_data': hourly_counts,
-        'daily_labels': daily_labels,
-        'daily_data': daily_values,
+        'hourly_data': totals['hourly'],
+        'daily_labels': totals['daily_labels'],
+        'daily_data': totals['daily'],
         'weekly_labels': ['月', '火', '水', '木', '金', '土', '日'],
-        'weekly_data': weekly_counts
+        'weekly_data': totals['weekly']
     }
-    return render_template('admin_visuals.html', chart_data=chart_data)
+    return render_template(
+        'admin_visuals.html',
+        chart_data=chart_data,
+        period=period,
+        filters={'from': request.args.get('from', ''), 'to': request.args.get('to', '')},
+        rate_days=ANALYTICS_RATE_DAYS,
+        unit_stats=usage_analytics.unit_consumption(unit_stock_list(db), ANALYTICS_RATE_DAYS, now),
+        user_period=user_period,
+        user_stats=usage_analytics.user_frequency(*user_range, limit=ANALYTICS_TOP_USERS, rows=rows),
+        heatmap_period=heatmap_period,
+        heatmap=usage_analytics.heatmap(*heatmap_range, rows=rows),
+    )
 
 @app.route('/admin/csv_export')
 def admin_csv_export():
-    """利用履歴をCSV形式でダウンロードする"""
+    """利用履歴をCSV形式で作成する (バックグラウンドジョブ。?from=&to= で期間を指定できる)"""
     if not session.get('admin_logged_in'):
         return redirect(url_for('admin_login'))
-    db = get_db()
-    logs = db.execute(
-        "SELECT txt FROM history WHERE txt LIKE '%利用を記録しました%' ORDER BY id ASC"
-    ).fetchall()
-    if not logs:
-        flash("ダウンロード対象の利用履歴がありません。", "warning")
-        return redirect(url_for('admin_dashboard'))
-    usage_data = []
-    for log in logs:
-        log_text = log['txt']
-        timestamp_str = log_text[:16]
-        match = re.search(r'\((\w+)\)', log_text)
-        card_id = match.group(1) if match else '不明'
-        usage_data.append({'timestamp': timestamp_str, 'card_id': card_id})
-    df = pd.DataFrame(usage_data)
-    output = io.StringIO()
-    df.to_csv(output, index=False)
-    output.seek(0)
-    return send_file(
-        io.BytesIO(output.read().encode('utf-8')),
-        mimetype='text/csv',
-        as_attachment=True,
-        download_name='usage_history.csv'
-    )
+    return submit_export_job('csv_export', '利用履歴CSV', usage_csv_job)
 
 @app.route('/admin/log_export')
 def admin_log_export():
-    """全ての履歴ログをCSV形式でダウンロードする"""
+    """全ての履歴ログをCSV形式で作成する (バックグラウンドジョブ。?from=&to= で期間を指定できる)"""
     if not session.get('admin_logged_in'):
         return redirect(url_for('admin_login'))
+    return submit_export_job('log_export', '全ログCSV', log_export_job)
 
-    db = get_db()
-    # 履歴テーブルから全てのログをIDの昇順（古い順）で取得
-    logs = db.execute("SELECT txt FROM history ORDER BY id ASC").fetchall()
-
-    if not logs:
-        flash("ダウンロード対象のログがありません。", "warning")
+def submit_export_job(kind, label, func):
+    """?from=&to= の期間を付けてエクスポートのジョブを登録する (期間が違えば別のジョブとして実行する)"""
+    try:
+        since, until = time_range_args()
+    except ValueError:
+        flash("期間は YYYY-MM-DD または YYYY-MM-DDTHH:MM の形式で指定してください。", "error")
         return redirect(url_for('admin_dashboard'))
+    if since is not None or until is not None:
+        label = f"{label} ({time_range_label()})"
+    return submit_admin_job(kind, label, func, since, until, key=(kind, since, until))
 
-    # DataFrameに変換しやすいようにリストに格納
-    log_data = [{'log_entry': log['txt']} for log in logs]
-    df = pd.DataFrame(log_data)
-
-    # CSVをメモリ上で作成
-    output = io.StringIO()
-    df.to_csv(output, index=False, header=['log']) # ヘッダーを'log'に指定
-    output.seek(0)
+@app.route('/admin/jobs')
+def admin_jobs():
+    """バックグラウンドジョブの一覧"""
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('admin_login'))
+    return render_template('admin_jobs.html', jobs=[public_job(job) for job in job_runner.list()])
 
-    # ファイルとして送信
+@app.route('/admin/jobs/<job_id>/download')
+def admin_job_download(job_id):
+    """完了したジョブの成果物をダウンロードする"""
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('admin_login'))
+    job = job_runner.get(job_id)
+    if not job or job['status'] != 'done' or not job['artifact'] or not os.path.exists(job['artifact']):
+        flash("ダウンロードできるファイルがありません。", "error")
+        return redirect(url_for('admin_jobs'))
     return send_file(
-        io.BytesIO(output.read().encode('utf-8')),
-        mimetype='text/csv',
+        job['artifact'],
+        mimetype=job['mimetype'],
         as_attachment=True,
-        download_name='all_history_logs.csv'
+        download_name=job['download_name']
     )
 
+@app.route('/api/jobs', methods=['GET'])
+def api_jobs():
+    """ジョブの一覧と状態 (管理者ログインが必要)"""
+    if not session.get('admin_logged_in'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify([public_job(job) for job in job_runner.list()])
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_job_status(job_id):
+    """ジョブの状態と進捗 (管理者ログインが必要)"""
+    if not session.get('admin_logged_in'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    job = job_runner.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(public_job(job))
+
 # ↑↑↑↑ ここまで貼り付け ↑↑↑↑
 @app.route("/")
 def index():
@@ -357,7 +2200,10 @@ def register():
                 # DBに新しいユーザーを登録
                 now = datetime.now().strftime("%Y-%m-%d %H:%M")
                 db.execute("INSERT INTO users (card_id, entry) VALUES (?, ?)", (card_id, now))
+                federation_enqueue(db, 'register', card_id, {'entry': now})
                 db.commit()
+                card_cache.invalidate(card_id)  # 未登録としてキャッシュされている場合があるため
+                event_bus.publish('user', {'action': 'added', 'count': 1})
                 add_history(f"新規登録({card_id})")
                 flash(f"登録が完了しました。(カードID: {card_id})", "success")
             except sqlite3.IntegrityError:
@@ -371,15 +2217,7 @@ def register():
 
     # GETリクエスト（ページ表示時）
     # ページ表示時にリーダーの接続状態を確認し、結果をテンプレートに渡す
-    reader_connected = False
-    try:
-        if nfc:
-            with nfc.ContactlessFrontend('usb'):
-                reader_connected = True
-    except Exception:
-        reader_connected = False
-        
-    return render_template("register.html", reader_connected=reader_connected)
+    return render_template("register.html", reader_connected=check_reader_connected())
 
 
 
@@ -406,15 +2244,7 @@ def usage():
             return redirect(url_for("usage"))
 
     # GETリクエスト（ページ表示時）
-    reader_connected = False
-    try:
-        if nfc is not None:
-            with nfc.ContactlessFrontend('usb'):
-                reader_connected = True
-    except Exception:
-        reader_connected = False
-    
-    return render_template("usage.html", reader_connected=reader_connected)
+    return render_template("usage.html", reader_connected=check_reader_connected())
 
 @app.route("/admin", methods=["GET", "POST"])
 def admin_login():
@@ -436,18 +2266,25 @@ def admin_dashboard():
     if not session.get("admin_logged_in"):
         return redirect(url_for("admin_login"))
     db = get_db()
-    users = db.execute("SELECT * FROM users").fetchall()
-    units = db.execute("SELECT * FROM units").fetchall()
-    history = db.execute("SELECT * FROM history ORDER BY id DESC").fetchall()
-    return render_template("admin_dashboard.html", users=users, units=units, history=history)
+    # 件数だけを数え、以降の変化は /admin/events (SSE) で画面側が反映する
+    counts = {
+        'users': db.execute("SELECT COUNT(*) FROM users").fetchone()[0],
+        'units': db.execute("SELECT COUNT(*) FROM units").fetchone()[0],
+        'history': db.execute("SELECT COUNT(*) FROM history").fetchone()[0],
+    }
+    units = db.execute("SELECT id, name, stock, connect, available FROM units ORDER BY id").fetchall()
+    recent_logs = db.execute("SELECT id, txt FROM history ORDER BY id DESC LIMIT 20").fetchall()
+    return render_template("admin_dashboard.html", counts=counts, units=units, recent_logs=recent_logs)
 
 @app.route("/admin/users")
 def admin_users():
     if not session.get("admin_logged_in"):
         return redirect(url_for("admin_login"))
     db = get_db()
-    users = db.execute("SELECT * FROM users").fetchall()
-    return render_template("admin_users.html", users=users)
+    return cached_render(
+        ('users',), "admin_users.html",
+        lambda: {'users': db.execute("SELECT * FROM users").fetchall()}
+    )
 
 @app.route("/admin/user_detail/<int:uid>", methods=["GET", "POST"])
 def admin_user_detail(uid):
@@ -458,20 +2295,30 @@ def admin_user_detail(uid):
         card_id = request.form.get("cardid")
         allow = request.form.get("allow")
         stock = request.form.get("stock")
+        # 変更前のカードIDもキャッシュから破棄する必要があるため先に取得しておく
+        old_user = db.execute("SELECT card_id FROM users WHERE id = ?", (uid,)).fetchone()
+        old_card_ids = [old_user['card_id']] if old_user else []
         if not card_id:
             db.execute("DELETE FROM users WHERE id = ?", (uid,))
+            for old_card_id in old_card_ids:
+                federation_enqueue(db, 'delete', old_card_id, {})
             add_history(f"利用者削除(ID:{uid})")
             flash(f"利用者(ID:{uid})を削除しました。", "success")
             db.commit()
+            card_cache.invalidate(*old_card_ids)
+            event_bus.publish('user', {'action': 'deleted', 'count': len(old_card_ids)})
             return redirect(url_for("admin_users"))
         else:
             db.execute(
                 "UPDATE users SET card_id = ?, allow = ?, stock = ? WHERE id = ?",
                 (card_id, allow, stock, uid)
             )
+            for old_card_id in old_card_ids:
+                federation_enqueue(db, 'update', old_card_id, {'card_id': card_id, 'allow': allow, 'stock': stock})
             add_history(f"利用者更新(ID:{uid})")
             flash(f"利用者(ID:{uid})の情報を更新しました。", "success")
             db.commit()
+            card_cache.invalidate(card_id, *old_card_ids)
             return redirect(url_for("admin_user_detail", uid=uid))
     user = db.execute("SELECT * FROM users WHERE id = ?", (uid,)).fetchone()
     if not user:
@@ -487,35 +2334,14 @@ def admin_units():
         return redirect(url_for('admin_login'))
     
     db = get_db()
-
-    # --- ハートビートのタイムアウト処理 ---
-    # 子機クライアント(unit_client.py)は30秒ごとにハートビートを送信するため、
-    # 65秒以上信号がなければオフラインと判断する。
-    HEARTBEAT_TIMEOUT = timedelta(seconds=65) 
-    now = datetime.now()
-    
-    # 現在オンライン(connect=1)になっている子機を取得
-    active_units = db.execute("SELECT * FROM units WHERE connect = 1").fetchall()
-    
-    for unit in active_units:
-        if unit['last_seen']:
-            try:
-                last_seen_dt = datetime.strptime(unit['last_seen'], "%Y-%m-%d %H:%M:%S")
-                # 最終接続時刻からタイムアウト時間を経過しているか確認
-                if now - last_seen_dt > HEARTBEAT_TIMEOUT:
-                    # タイムアウトした場合、接続状態をオフライン(0)に更新
-                    db.execute("UPDATE units SET connect = 0 WHERE id = ?", (unit['id'],))
-                    add_history(f"子機がタイムアウトしました: {unit['name']}")
-            except ValueError:
-                # 日付の形式が不正な場合はスキップ
-                continue
-    
-    db.commit() # 状態の更新を確定
-    # --- タイムアウト処理ここまで ---
+    # ハートビートのタイムアウト処理 (バックグラウンドでも定期的に行っている)
+    mark_timed_out_units(db)
 
     # 最新の状態をDBから再度取得して表示
-    all_units = db.execute("SELECT * FROM units ORDER BY id").fetchall()
-    return render_template("admin_units.html", units=all_units)
+    return cached_render(
+        ('units',), "admin_units.html",
+        lambda: {'units': db.execute("SELECT * FROM units ORDER BY id").fetchall()}
+    )
 
 @app.route("/admin/unit_detail/<int:uid>", methods=["GET", "POST"])
 def admin_unit_detail(uid):
@@ -529,11 +2355,42 @@ def admin_unit_detail(uid):
         name = request.form.get("name")
         stock = request.form.get("stock")
         available = request.form.get("available")
+        settings_text = request.form.get("settings", "").strip()
+        settings = None
+        if settings_text:
+            try:
+                overrides = json.loads(settings_text)
+            except ValueError as e:
+                flash(f"詳細設定のJSONが不正です: {e}", "error")
+                return redirect(url_for("admin_unit_detail", uid=uid))
+            if not isinstance(overrides, dict):
+                flash("詳細設定はJSONオブジェクトで指定してください。", "error")
+                return redirect(url_for("admin_unit_detail", uid=uid))
+            unknown_keys = set(overrides) - UNIT_SETTING_KEYS
+            if unknown_keys:
+                flash(f"不明な設定キーがあります: {', '.join(sorted(unknown_keys))}", "error")
+                return redirect(url_for("admin_unit_detail", uid=uid))
+            errors = [e for e in (unit_setting_error(k, v) for k, v in overrides.items()) if e]
+            if errors:
+                for error in errors:
+                    flash(error, "error")
+                return redirect(url_for("admin_unit_detail", uid=uid))
+            settings = json.dumps(overrides, ensure_ascii=False)
+        old_unit = db.execute("SELECT name FROM units WHERE id = ?", (uid,)).fetchone()
+        # 設定を変更したら config_version を上げ、次のハートビートで子機に配信する
         db.execute(
-            "UPDATE units SET name = ?, stock = ?, available = ? WHERE id = ?",
-            (name, stock, available, uid)
+            """
+            UPDATE units SET name = ?, stock = ?, available = ?, settings = ?,
+                             config_version = COALESCE(config_version, 1) + 1
+            WHERE id = ?
+            """,
+            (name, stock, available, settings, uid)
         )
         db.commit()
+        if old_unit and old_unit['name'] != name:
+            # トークンには子機名が入っているため、名前を変えたら取り直させる
+            unit_tokens.revoke_unit(uid)
+        publish_unit(db, uid)
         add_history(f"子機情報を更新しました (ID:{uid}, 名前:{name})")
         flash(f"子機(ID:{uid})の情報を更新しました。", "success")
         return redirect(url_for("admin_unit_detail", uid=uid))
@@ -544,69 +2401,263 @@ def admin_unit_detail(uid):
         flash("指定された子機が見つかりません。", "error")
         return redirect(url_for('admin_units'))
 
-    # --- ログ取得ロジックを追加 ---
-    unit_name = unit['name']
-    search_pattern = f"%[{unit_name}]%"
-    logs = db.execute(
-        "SELECT txt FROM history WHERE txt LIKE ? ORDER BY id DESC", 
-        (search_pattern,)
-    ).fetchall()
-    # --- ここまで追加 ---
+    # --- 子機のログ (最新1ページ分) を全文検索インデックスから取得 ---
+    logs, has_more_logs = search_history(db, unit_name=unit['name'])
 
     # 取得した子機情報とログをテンプレートに渡す
-    return render_template("admin_unit_detail.html", unit=unit, logs=logs)
+    return render_template("admin_unit_detail.html", unit=unit, logs=logs, has_more_logs=has_more_logs)
+
+@app.route("/admin/unit_detail/<int:uid>/revoke", methods=["POST"])
+def admin_unit_revoke(uid):
+    """子機に発行済みの認証トークンを失効させる (子機は次の通信でトークンを取り直す)"""
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('admin_login'))
+    unit_tokens.revoke_unit(uid)
+    add_history(f"子機の認証トークンを失効させました (ID:{uid})")
+    flash(f"子機(ID:{uid})の認証トークンを失効させました。", "success")
+    return redirect(url_for("admin_unit_detail", uid=uid))
+
+@app.route("/admin/unit_tokens/rotate", methods=["POST"])
+def admin_unit_tokens_rotate():
+    """子機トークンの署名鍵をローテーションする"""
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('admin_login'))
+    unit_tokens.rotate()
+    add_history("子機トークンの署名鍵をローテーションしました")
+    flash("署名鍵をローテーションしました。発行済みのトークンは有効期限まで使えます。", "success")
+    return redirect(url_for("admin_units"))
 
 @app.route("/admin/history")
 def admin_history():
     if not session.get('admin_logged_in'):
         return redirect(url_for('admin_login'))
+    filters = {
+        'q': request.args.get('q', '').strip(),
+        'card_id': request.args.get('card_id', '').strip(),
+        'unit': request.args.get('unit', '').strip(),
+        'from': request.args.get('from', '').strip(),
+        'to': request.args.get('to', '').strip(),
+    }
+    page = request.args.get('page', 1, type=int)
+    times = {}
+    for key in ('from', 'to'):
+        if filters[key]:
+            try:
+                times[key] = parse_time_arg(filters[key], end=(key == 'to'))
+            except ValueError:
+                flash("日付は YYYY-MM-DD (時刻も指定する場合は YYYY-MM-DDTHH:MM) の形式で指定してください。", "error")
+                filters[key] = ''
     db = get_db()
-    history = db.execute("SELECT * FROM history ORDER BY id DESC").fetchall()
-    return render_template("admin_history.html", history=history)
+
+    def build_context():
+        history, has_next = search_history(
+            db,
+            keyword=filters['q'] or None,
+            card_id=filters['card_id'] or None,
+            unit_name=filters['unit'] or None,
+            since=times.get('from'),
+            until=times.get('to'),
+            page=page,
+        )
+        units = db.execute("SELECT name FROM units ORDER BY name").fetchall()
+        # ページ移動用のリンクで検索条件を引き継ぐ
+        query_args = {k: v for k, v in filters.items() if v}
+        return dict(
+            history=history, filters=filters, units=units,
+            page=page, has_next=has_next, query_args=query_args
+        )
+    return cached_render(('history', 'units'), "admin_history.html", build_context)
+
+@app.route("/admin/archive", methods=["GET", "POST"])
+def admin_archive():
+    """履歴アーカイブの一覧と、アーカイブ・VACUUMの手動実行"""
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('admin_login'))
+    if request.method == "POST":
+        force_vacuum = request.form.get("action") == "vacuum"
+        if history_maintenance_lock.locked():
+            flash("アーカイブ処理は既に実行中です。", "warning")
+        else:
+            # 時間がかかるためバックグラウンドで実行する
+            threading.Thread(
+                target=run_history_maintenance, kwargs={'force_vacuum': force_vacuum}, daemon=True
+            ).start()
+            flash("アーカイブ処理を開始しました。", "success")
+        return redirect(url_for("admin_archive"))
+    return render_template(
+        "admin_archive.html", archives=list_archives(),
+        retention_days=HISTORY_RETENTION_DAYS, running=history_maintenance_lock.locked()
+    )
+
+@app.route("/admin/archive/<month>")
+def admin_archive_month(month):
+    """アーカイブファイルの内容を検索・表示・エクスポートする"""
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('admin_login'))
+    if not re.fullmatch(r'\d{4}-\d{2}|unknown', month) or not os.path.exists(archive_path(month)):
+        flash("指定されたアーカイブは見つかりません。", "error")
+        return redirect(url_for('admin_archive'))
+    keyword = request.args.get('q', '').strip()
+    rows = read_archive(month, keyword or None)
+    if request.args.get('download'):
+        df = pd.DataFrame([{'id': row_id, 'log': txt} for row_id, txt in rows], columns=['id', 'log'])
+        output = io.StringIO()
+        df.to_csv(output, index=False)
+        output.seek(0)
+        return send_file(
+            io.BytesIO(output.read().encode('utf-8')),
+            mimetype='text/csv',
+            as_attachment=True,
+            download_name=f'history_{month}.csv'
+        )
+    # 表示は新しい順に最大 HISTORY_PAGE_SIZE 件まで (全件はダウンロードで取得する)
+    return render_template(
+        "admin_archive_month.html", month=month, keyword=keyword,
+        rows=rows[::-1][:HISTORY_PAGE_SIZE], total=len(rows)
+    )
+
+@app.route("/admin/enroll")
+def admin_enroll():
+    """連続登録モードと一括インポートの画面"""
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('admin_login'))
+    return render_template("admin_enroll.html", running=continuous_enrollment.running)
+
+@app.route("/admin/enroll/<action>", methods=["POST"])
+def admin_enroll_control(action):
+    """連続登録モードの開始・停止"""
+    if not session.get('admin_logged_in'):
+        return redirect(url_for('admin_login'))
+    if action == "start":
+        if continuous_enrollment.start():
+            add_history("連続登録モードを開始")
+            flash("連続登録モードを開始しました。", "success")
+        else:
+            flash("連続登録モードは既に実行中です。", "warning")
+    elif action == "stop":
+        continuous_enrollment.stop()
+        add_history("連続登録モードを停止")
+        flash("連続登録モードを停止しました。", "success")
+    return redirect(url_for("admin_enroll"))
+
+@app.route("/admin/enroll/feed")
+def admin_enroll_feed():
+    """連続登録の結果のうち、after より後のものを返す"""
+    if not session.get('admin_logged_in'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    after = request.args.get('after', 0, type=int)
+    return jsonify({
+        'running': continuous_enrollment.running,
+        'stats': continuous_enrollment.stats,
+        'events': continuous_enrollment.events_after(after),
+    })
+
+@app.route("/admin/events")
+def admin_events():
+    """利用・子機状態・ログのイベントを Server-Sent Events で配信する"""
+    if not session.get('admin_logged_in'):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    def stream():
+        q = event_bus.subscribe()
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event = q.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                data = json.dumps(event['data'], ensure_ascii=False)
+                yield f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n"
+        finally:
+            event_bus.unsubscribe(q)
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
 
 # --- REST API ---
 
 
-@app.route('/api/unit/heartbeat', methods=['POST'])
-def unit_heartbeat():
-    """子機からの生存確認を受け取り、接続状態を更新または新規登録する"""
+@app.route('/api/unit/token', methods=['POST'])
+def unit_token():
+    """子機の名前とパスワードを確認して認証トークンを発行する。未登録の子機は自動で登録する"""
     data = request.json
     unit_name = data.get('name')
     unit_pass = data.get('password')
 
     if not all([unit_name, unit_pass]):
         return jsonify({'error': 'Name and password are required'}), 400
-    
+
     db = get_db()
     unit = db.execute("SELECT * FROM units WHERE name = ?", (unit_name,)).fetchone()
-    now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    status = 200
 
     # 1. もし子機が未登録（None）だったら、自動で新規登録する
     if unit is None:
         # 新しい子機をDBに追加。在庫は0、接続・利用可は1で初期化
+        now = datetime.now()
         db.execute(
             """
-            INSERT INTO units (name, password, stock, connect, available, last_seen)
-            VALUES (?, ?, 0, 1, 1, ?)
+            INSERT INTO units (name, password, stock, connect, available, last_seen, last_seen_at)
+            VALUES (?, ?, 0, 1, 1, ?, ?)
             """,
-            (unit_name, unit_pass, now_str)
+            (unit_name, unit_pass, now.strftime("%Y-%m-%d %H:%M:%S"), int(now.timestamp()))
         )
         db.commit()
         add_history(f"子機を自動登録しました: {unit_name}")
-        return jsonify({'success': True, 'message': 'Unit auto-registered and heartbeat received'}), 201
+        unit = db.execute("SELECT * FROM units WHERE name = ?", (unit_name,)).fetchone()
+        publish_unit(db, unit['id'])
+        status = 201
 
     # 2. 登録済みの子機の場合、パスワードを検証
-    if unit['password'] != unit_pass:
+    elif unit['password'] != unit_pass:
         return jsonify({'error': 'Invalid credentials'}), 401
 
-    # 3. 従来通り、接続状態と最終接続時刻を更新
-    db.execute(
-        "UPDATE units SET connect = 1, last_seen = ? WHERE id = ?",
-        (now_str, unit['id'])
-    )
-    db.commit()
-    
-    return jsonify({'success': True, 'message': 'Heartbeat received'}), 200
+    token, expires_in = unit_tokens.issue(unit['id'], unit['name'])
+    return jsonify({'success': True, 'token': token, 'expires_in': expires_in}), status
+
+@app.route('/api/unit/heartbeat', methods=['POST'])
+def unit_heartbeat():
+    """子機からの生存確認を受け取り、接続状態を更新する (要トークン)"""
+    unit_auth = verify_unit_token()
+    if unit_auth is None:
+        return jsonify({'error': 'Invalid or expired token'}), 401
+    data = request.json or {}
+    # 子機がキャッシュしている設定のバージョン (未取得なら0)
+    client_version = data.get('config_version', 0)
+    response = record_heartbeats(get_db(), [(unit_auth['uid'], client_version)])[0]
+    if response is None:
+        return jsonify({'error': 'Unit not found'}), 404
+    return jsonify(response), 200
+
+@app.route('/api/unit/heartbeat/batch', methods=['POST'])
+def unit_heartbeat_batch():
+    """
+    1つのプロセスで動く複数の子機のハートビートをまとめて受け取る。
+    子機ごとにトークンを検証し、送られてきた順に結果を返す。
+    """
+    data = request.json or {}
+    beats = data.get('units')
+    if not isinstance(beats, list) or not beats:
+        return jsonify({'error': 'units must be a non-empty list'}), 400
+    if len(beats) > HEARTBEAT_BATCH_MAX:
+        return jsonify({'error': f'Too many units (max {HEARTBEAT_BATCH_MAX})'}), 400
+
+    results = [None] * len(beats)
+    verified = []  # (結果の位置, 子機ID, 設定バージョン)
+    for index, beat in enumerate(beats):
+        unit_auth = unit_tokens.verify(beat.get('token', '')) if isinstance(beat, dict) else None
+        if unit_auth is None:
+            results[index] = {'error': 'Invalid or expired token', 'status': 401}
+        else:
+            verified.append((index, unit_auth['uid'], beat.get('config_version', 0)))
+    responses = record_heartbeats(get_db(), [(uid, version) for _, uid, version in verified])
+    for (index, _, _), response in zip(verified, responses):
+        results[index] = response if response is not None else {'error': 'Unit not found', 'status': 404}
+    return jsonify({'results': results}), 200
 
 @app.route("/api/health")
 def health_check():
@@ -614,6 +2665,9 @@ def health_check():
     return jsonify({"status": "ok", "timestamp": datetime.now().isoformat()})
 @app.route("/api/reader_status")
 def reader_status():
+    # 連続登録モード中はリーダーを占有しているため、開き直さずに接続中として返す
+    if continuous_enrollment.running:
+        return jsonify({"connected": True, "error": None, "enrolling": True})
     try:
         if nfc is None:
             raise ImportError("nfcpy not installed")
@@ -636,20 +2690,201 @@ def api_get_users():
     users = db.execute('SELECT * FROM users').fetchall()
     return jsonify([dict(row) for row in users])
 
+@app.route('/api/users/bulk', methods=['POST'])
+def api_bulk_import_users():
+    """
+    利用者の一括インポート (管理者ログインが必要)。
+    CSV (text/csv, 1行目はヘッダー) / NDJSON (application/x-ndjson) / JSON配列を受け付ける。
+    本文を読みながら BULK_IMPORT_BATCH_SIZE 件ずつ登録し、衝突・エラーはデータの行番号
+    (ヘッダーを除いて1から数える) 付きで返す。
+    """
+    if not session.get('admin_logged_in'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    content_type = request.content_type or ''
+    inserted_count = 0
+    conflicts, errors, batch = [], [], []
+
+    def flush():
+        nonlocal inserted_count
+        inserted, batch_conflicts = enroll_users(batch)
+        inserted_count += len(inserted)
+        conflicts.extend(batch_conflicts)
+        batch.clear()
+
+    for line_no, (record, error) in enumerate(iter_bulk_records(request.stream, content_type), start=1):
+        if error is None:
+            try:
+                if not isinstance(record, dict):
+                    raise ValueError('row must be an object')
+                card_id, fields = parse_bulk_row(record)
+            except (ValueError, TypeError) as e:
+                error = e
+        if error is not None:
+            errors.append({'ref': line_no, 'error': str(error)})
+            continue
+        batch.append((line_no, card_id, fields))
+        if len(batch) >= BULK_IMPORT_BATCH_SIZE:
+            flush()
+    if batch:
+        flush()
+
+    if inserted_count:
+        add_history(f"一括インポート: {inserted_count}件を登録")
+    status = 200 if not errors else 207
+    return jsonify({
+        'success': not errors,
+        'inserted': inserted_count,
+        'conflicts': conflicts,
+        'errors': errors,
+    }), status
+
 @app.route('/api/users/<string:card_id>', methods=['GET'])
 def api_get_user_by_card(card_id):
-    db = get_db()
-    user = db.execute('SELECT * FROM users WHERE card_id = ?', (card_id,)).fetchone()
+    if verify_unit_token() is None:
+        return jsonify({'error': 'Invalid or expired token'}), 401
+    user = lookup_user_by_card(card_id)
     if user:
-        return jsonify(dict(user))
+        return jsonify(user)
     return jsonify({'error': 'User not found'}), 404
 
+@app.route('/api/analytics/units')
+def api_analytics_units():
+    """子機ごとの消費ペースと在庫切れまでの見込み (?days=N で期間を指定。管理者ログインが必要)"""
+    if not session.get('admin_logged_in'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    days = request.args.get('days', ANALYTICS_RATE_DAYS, type=int)
+    if days <= 0:
+        return jsonify({'error': 'days must be positive'}), 400
+    db = get_db()
+    refresh_usage_analytics(db)
+    return jsonify({
+        'days': days,
+        'units': usage_analytics.unit_consumption(unit_stock_list(db), days, datetime.now()),
+    })
+
+@app.route('/api/analytics/users')
+def api_analytics_users():
+    """利用者ごとの利用回数の上位と分布 (?days=N または ?month=YYYY-MM。既定は今月。管理者ログインが必要)"""
+    if not session.get('admin_logged_in'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    db = get_db()
+    refresh_usage_analytics(db)
+    try:
+        since, until, label, rows = analytics_period(db)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    limit = min(max(request.args.get('limit', ANALYTICS_TOP_USERS, type=int), 1), 1000)
+    result = usage_analytics.user_frequency(since, until, limit=limit, rows=rows)
+    result['period'] = label
+    return jsonify(result)
+
+@app.route('/api/analytics/heatmap')
+def api_analytics_heatmap():
+    """曜日×時間帯の利用回数 (?days=N または ?month=YYYY-MM。既定は直近28日。管理者ログインが必要)"""
+    if not session.get('admin_logged_in'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    db = get_db()
+    refresh_usage_analytics(db)
+    try:
+        since, until, label, rows = analytics_period(db, default_days=ANALYTICS_HEATMAP_DAYS)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    result = usage_analytics.heatmap(since, until, rows=rows)
+    result['period'] = label
+    return jsonify(result)
+
+@app.route('/api/cache/stats', methods=['GET'])
+def api_cache_stats():
+    """カード情報キャッシュと管理画面の表示キャッシュのヒット率などを返す (管理者ログインが必要)"""
+    if not session.get('admin_logged_in'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify({'card_cache': card_cache.stats(), 'render_cache': render_cache.stats()})
+
+@app.route('/api/federation/events', methods=['POST'])
+def api_federation_events():
+    """エッジから利用記録と利用者の変更を受け取り、中央のDBに反映する (共有鍵が必要)"""
+    if not verify_federation_key():
+        return jsonify({'error': 'Invalid federation key'}), 401
+    if SITE_MODE != 'central':
+        return jsonify({'error': 'This server is not a central site'}), 404
+    data = request.get_json(silent=True) or {}
+    site, events = data.get('site'), data.get('events')
+    if not isinstance(site, str) or not site or not isinstance(events, list):
+        return jsonify({'error': 'site and events are required'}), 400
+    for event in events:
+        if not isinstance(event, dict) or not all(isinstance(event.get(k), str) for k in ('id', 'kind', 'card_id')):
+            return jsonify({'error': 'each event needs string id, kind and card_id'}), 400
+    db = get_db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        lines = []
+        for event in events:
+            lines.extend(apply_federation_event(db, site, event))
+        db.executemany("INSERT INTO history (created_at, txt) VALUES (?, ?)", lines)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    card_ids = {event['card_id'] for event in events}
+    card_ids.update((event.get('payload') or {}).get('card_id') for event in events if event['kind'] == 'update')
+    card_cache.invalidate(*[c for c in card_ids if c])
+    for _, txt in lines:
+        event_bus.publish('log', {'id': None, 'txt': txt})
+    if events:
+        event_bus.publish('user', {'action': 'synced', 'count': len(events)})
+    return jsonify({'acked': [event['id'] for event in events]})
+
+@app.route('/api/federation/changes', methods=['GET'])
+def api_federation_changes():
+    """?since= より後に変わった利用者の最新の行を返す (削除されたカードは deleted。共有鍵が必要)"""
+    if not verify_federation_key():
+        return jsonify({'error': 'Invalid federation key'}), 401
+    if SITE_MODE != 'central':
+        return jsonify({'error': 'This server is not a central site'}), 404
+    since = request.args.get('since', 0, type=int)
+    limit = min(max(request.args.get('limit', FEDERATION_BATCH_SIZE, type=int), 1), 5000)
+    rows = get_db().execute("""
+        SELECT c.seq AS seq, c.card_id AS change_card_id, u.*
+        FROM (SELECT card_id, MAX(seq) AS seq FROM user_changes WHERE seq > ? GROUP BY card_id) c
+        LEFT JOIN users u ON u.card_id = c.card_id
+        ORDER BY c.seq LIMIT ?
+    """, (since, limit + 1)).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    changes = []
+    for row in rows:
+        if row['id'] is None:
+            changes.append({'card_id': row['change_card_id'], 'deleted': True})
+        else:
+            user = {key: row[key] for key in row.keys() if key not in ('seq', 'change_card_id', 'id')}
+            changes.append({'card_id': row['change_card_id'], 'user': user})
+    return jsonify({'changes': changes, 'cursor': rows[-1]['seq'] if rows else since, 'more': more})
+
+@app.route('/api/federation/status', methods=['GET'])
+def api_federation_status():
+    """拠点間の同期の状態 (未送信のイベント数、最後に同期した時刻など。管理者ログインが必要)"""
+    if not session.get('admin_logged_in'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    db = get_db()
+    cursor = db.execute("SELECT value FROM federation_state WHERE key = 'cursor'").fetchone()
+    return jsonify({
+        'mode': SITE_MODE,
+        'site': SITE_NAME,
+        'central_url': CENTRAL_URL or None,
+        'pending_events': db.execute("SELECT COUNT(*) FROM federation_outbox").fetchone()[0],
+        'cursor': int(cursor['value']) if cursor else 0,
+        **federation_status,
+    })
+
 @app.route('/api/log', methods=['POST'])
 def api_add_log():
-    """子機からのログを受け取り、子機名を付けて保存する"""
+    """子機からのログを受け取り、子機名を付けて保存する (要トークン)"""
+    unit_auth = verify_unit_token()
+    if unit_auth is None:
+        return jsonify({'error': 'Invalid or expired token'}), 401
     data = request.json
     message = data.get('message')
-    unit_name = data.get('unit_name', '不明な子機') # 子機名を取得、なければ'不明な子機'
+    unit_name = unit_auth['name']  # 子機名はトークンから取得する
 
     if message:
         # ログメッセージに子機名を付ける
@@ -660,34 +2895,52 @@ def api_add_log():
 
 @app.route('/api/record_usage', methods=['POST'])
 def api_record_usage():
+    unit_auth = verify_unit_token()
+    if unit_auth is None:
+        return jsonify({'error': 'Invalid or expired token'}), 401
     data = request.json
     card_id = data.get('card_id')
     if not card_id:
         return jsonify({'error': 'Card ID is required'}), 400
+    tap_id = data.get('tap_id')
+    if tap_id is not None and (not isinstance(tap_id, str) or not 0 < len(tap_id) <= TAP_ID_MAX_LENGTH):
+        return jsonify({'error': f'tap_id must be a string of 1-{TAP_ID_MAX_LENGTH} characters'}), 400
     db = get_db()
-    user = db.execute("SELECT * FROM users WHERE card_id = ?", (card_id,)).fetchone()
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    if user['stock'] <= 0:
-        return jsonify({'error': 'No stock remaining'}), 400
-    new_stock = user['stock'] - 1
-    new_total = user['total'] + 1
-    new_today = user['today'] + 1
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    history_updates = {f"last{i+1}": user[f"last{i}"] for i in range(1, 10)}
-    history_updates["last1"] = now
-    set_clauses = ["stock = ?", "total = ?", "today = ?"]
-    update_values = [new_stock, new_total, new_today]
-    for key, value in history_updates.items():
-        set_clauses.append(f"{key} = ?")
-        update_values.append(value)
-    update_query = f"UPDATE users SET {', '.join(set_clauses)} WHERE card_id = ?"
-    update_values.append(card_id)
-    db.execute(update_query, tuple(update_values))
-    db.commit()
-    return jsonify({'success': True, 'message': 'Usage recorded successfully.'})
+    # 重複チェックから結果の保存までを1つの書き込みトランザクションで行い、
+    # 同じタップIDの再送が並行して届いても二重に記録しないようにする
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        if tap_id is not None:
+            replay = db.execute(
+                "SELECT status, response FROM usage_dedup WHERE unit_id = ? AND tap_id = ?",
+                (unit_auth['uid'], tap_id)
+            ).fetchone()
+            if replay is not None:
+                db.rollback()
+                resp = jsonify(json.loads(replay['response']))
+                resp.headers['Idempotent-Replay'] = 'true'
+                return resp, replay['status']
+        status, body, unit, event = apply_usage(db, unit_auth['uid'], card_id)
+        if tap_id is not None:
+            db.execute(
+                "INSERT INTO usage_dedup (unit_id, tap_id, created_at, status, response) VALUES (?, ?, ?, ?, ?)",
+                (unit_auth['uid'], tap_id, int(time.time()), status, json.dumps(body))
+            )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    if event is not None:
+        card_cache.invalidate(card_id)
+        event_bus.publish('usage', event)
+        if unit is not None:
+            publish_unit(db, unit['id'])
+    return jsonify(body), status
 
 if __name__ == '__main__':
     migrate_db()
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # debug=True のリローダーは子プロセスでアプリを動かすため、そちらでのみスレッドを起動する
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_workers()
+    app.run(host='0.0.0.0', port=SERVER_PORT, debug=True)
 
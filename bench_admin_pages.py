@@ -0,0 +1,85 @@
+"""
+管理画面の表示キャッシュ (RenderCache) のベンチマーク。
+
+一時的なデータベースに利用者と履歴を登録し、利用者一覧・子機一覧・履歴の各ページについて
+1回あたりの応答時間を「キャッシュなし」「キャッシュあり」「ETagで304」の3通りで比較する。
+
+    python bench_admin_pages.py --users 50000 --history 20000 --repeat 20
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import app as oiteru
+
+PAGES = ["/admin/users", "/admin/units", "/admin/history", "/admin/history?q=%E5%88%A9%E7%94%A8&page=2"]
+
+
+def prepare_db(source, path, users, history):
+    """ベンチマーク用のデータベースを作成する"""
+    shutil.copy(source, path)
+    db = sqlite3.connect(path)
+    with db:
+        db.executemany(
+            "INSERT OR IGNORE INTO users (card_id, entry, stock, total, last1) "
+            "VALUES (?, '2025-04-01 09:00', 2, 10, '2025-08-01 12:00:00')",
+            [(f"bench{i:011x}",) for i in range(users)]
+        )
+        db.executemany(
+            "INSERT INTO history (txt) VALUES (?)",
+            [(f"2025-08-01 12:{i % 60:02d}: [bench-{i % 8:02d}] 利用を記録しました (bench{i % users:011x})",)
+             for i in range(history)]
+        )
+    db.close()
+
+
+def measure(client, path, repeat, headers=None):
+    """path を repeat 回取得し、(1回あたりのミリ秒, 最後の応答) を返す"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        resp = client.get(path, headers=headers or {})
+    return (time.perf_counter() - start) / repeat * 1000, resp
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50000, help="登録する利用者数")
+    parser.add_argument("--history", type=int, default=20000, help="追加する履歴の件数")
+    parser.add_argument("--repeat", type=int, default=20, help="ページごとの取得回数")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        source = oiteru.DB_PATH
+        oiteru.DB_PATH = os.path.join(workdir, "bench.sqlite3")
+        prepare_db(source, oiteru.DB_PATH, args.users, args.history)
+        oiteru.migrate_db()
+        client = oiteru.app.test_client()
+        with client.session_transaction() as sess:
+            sess['admin_logged_in'] = True
+        print(f"利用者 {args.users}人 / 履歴 {args.history}件 / {args.repeat}回ずつ")
+        saved = 0.0
+        for path in PAGES:
+            oiteru.render_cache = oiteru.RenderCache(0)
+            uncached, resp = measure(client, path, args.repeat)
+            size = len(resp.data)
+            oiteru.render_cache = oiteru.RenderCache(oiteru.RENDER_CACHE_SIZE)
+            client.get(path)  # 1回目の描画をキャッシュに載せる
+            cached, resp = measure(client, path, args.repeat)
+            not_modified, resp = measure(client, path, args.repeat, {"If-None-Match": resp.headers["ETag"]})
+            assert resp.status_code == 304, resp.status_code
+            saved += oiteru.render_cache.stats()['saved_seconds']
+            print(f"{path}  ({size / 1024:.0f} KB)")
+            print(f"    キャッシュなし: {uncached:8.2f} ms")
+            print(f"    キャッシュあり: {cached:8.2f} ms  ({uncached / cached:.0f}倍)")
+            print(f"    304 (ETag)    : {not_modified:8.2f} ms  ({uncached / not_modified:.0f}倍)")
+        print(f"キャッシュと304応答で省けた描画時間の合計: {saved:.2f}秒")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+カード情報キャッシュ (CardCache) のベンチマーク。
+
+一時的なデータベースに利用者を登録し、複数の子機が同時にカードをタッチする状況を
+スレッドで再現して、/api/users/<card_id> の処理件数/秒をキャッシュ無効・有効で比較する。
+
+    python bench_card_lookup.py --users 10000 --units 8 --taps 2000
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+import app as oiteru
+
+BENCH_STOCK = 10 ** 9  # 書き込みが在庫切れで失敗しないよう、利用者と子機に持たせる在庫
+
+
+def prepare_db(source, path, users, units):
+    """ベンチマーク用のデータベースを作成し (子機も在庫付きで登録しておく)、カードIDの一覧を返す"""
+    shutil.copy(source, path)
+    db = sqlite3.connect(path)
+    card_ids = [f"bench{i:011x}" for i in range(users)]
+    with db:
+        db.executemany(
+            "INSERT OR IGNORE INTO users (card_id, entry, stock) VALUES (?, '2025-04-01 09:00', ?)",
+            [(card_id, BENCH_STOCK) for card_id in card_ids]
+        )
+        # 自動登録された子機は在庫0で、利用記録が "Unit out of stock" になるため先に登録する
+        db.executemany(
+            "INSERT OR REPLACE INTO units (name, password, stock, available) VALUES (?, 'bench', ?, 1)",
+            [(f"bench-{i:02d}", BENCH_STOCK) for i in range(units)]
+        )
+    db.close()
+    return card_ids
+
+
+def run_fleet(card_ids, units, taps, write_ratio):
+    """units 台の子機が taps 回ずつタッチする負荷をかけ、(経過秒, 総リクエスト数) を返す"""
+    # よく使う学生ほど頻繁にタッチする偏りを再現する (上位の利用者ほど選ばれやすい)
+    weights = [1 / (rank + 1) for rank in range(len(card_ids))]
+    barrier = threading.Barrier(units + 1)
+    counts = [0] * units
+    errors = []
+
+    def unit_worker(index):
+        client = oiteru.app.test_client()
+        rng = random.Random(index)
+        cards = rng.choices(card_ids, weights=weights, k=taps)
+        # 子機と同じく、最初に一度だけ認証トークンを取得する
+        token = client.post("/api/unit/token", json={"name": f"bench-{index:02d}", "password": "bench"}).json['token']
+        headers = {"Authorization": f"Bearer {token}"}
+        barrier.wait()
+        for card_id in cards:
+            client.get(f"/api/users/{card_id}", headers=headers)
+            counts[index] += 1
+            if rng.random() < write_ratio:
+                resp = client.post("/api/record_usage", json={"card_id": card_id}, headers=headers)
+                if not 200 <= resp.status_code < 300:
+                    errors.append(f"bench-{index:02d}: /api/record_usage が HTTP {resp.status_code} ({resp.json})")
+                    return
+                counts[index] += 1
+
+    threads = [threading.Thread(target=unit_worker, args=(i,)) for i in range(units)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise RuntimeError("利用記録の書き込みに失敗しました: " + "; ".join(errors))
+    return time.perf_counter() - start, sum(counts)
+
+
+def run_lookups(card_ids, lookups):
+    """HTTP処理を除いた検索そのもの (リクエストごとに接続を開く) の件数/秒を返す"""
+    weights = [1 / (rank + 1) for rank in range(len(card_ids))]
+    cards = random.Random(0).choices(card_ids, weights=weights, k=lookups)
+    start = time.perf_counter()
+    for card_id in cards:
+        with oiteru.app.app_context():
+            oiteru.lookup_user_by_card(card_id)
+    return lookups / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000, help="登録する利用者数")
+    parser.add_argument("--units", type=int, default=8, help="同時にタッチする子機の台数 (スレッド数)")
+    parser.add_argument("--taps", type=int, default=2000, help="子機1台あたりのタッチ回数")
+    parser.add_argument("--write-ratio", type=float, default=0.0,
+                        help="タッチのうち利用記録 (キャッシュ無効化) を伴う割合")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        source = oiteru.DB_PATH
+        oiteru.DB_PATH = os.path.join(workdir, "bench.sqlite3")
+        card_ids = prepare_db(source, oiteru.DB_PATH, args.users, args.units)
+        oiteru.migrate_db()
+        print(f"利用者 {args.users}人 / 子機 {args.units}台 x {args.taps}回 / 書き込み割合 {args.write_ratio}")
+        for label, maxsize in (("キャッシュなし", 0), ("キャッシュあり", oiteru.CARD_CACHE_SIZE)):
+            oiteru.card_cache = oiteru.CardCache(maxsize)
+            elapsed, requests = run_fleet(card_ids, args.units, args.taps, args.write_ratio)
+            stats = oiteru.card_cache.stats()
+            print(f"{label:>8}: {requests / elapsed:8.0f} req/s  ({elapsed:.2f}秒, "
+                  f"ヒット率 {stats['hit_ratio']:.1%}, 無効化 {stats['invalidations']}回)")
+            oiteru.card_cache = oiteru.CardCache(maxsize)
+            print(f"{'':>8}  検索のみ: {run_lookups(card_ids, args.units * args.taps):8.0f} 件/s")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
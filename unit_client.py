@@ -1,5 +1,6 @@
 import time
-import requests
+import asyncio
+import aiohttp
 import nfc
 import sys
 import threading
@@ -20,6 +21,10 @@ SERVER_URL = "http://192.168.11.4:5000"
 UNIT_NAME = "raspi-01"
 UNIT_PASSWORD = "password123"
 
+# === NFCリーダー ===
+# 使用するNFCリーダーを指定します。通常は 'usb' のままで構いません。
+NFC_DEVICE = 'usb'
+
 # === モーターの種類 ===
 # 使用するモーターの種類を選びます。
 # ・サーボモーターの場合: 'SERVO'
@@ -50,292 +55,664 @@ SENSOR_PIN = 22     # 排出検知センサー
 # `ls /dev/tty*` コマンドで調べて、'ttyACM0'や'ttyUSB0'などを指定します。
 ARDUINO_PORT = '/dev/ttyACM0'
 
+# === 複数の子機をまとめて動かす場合 ===
+# 1台のラズパイに複数のリーダーとモーターの組をつなぐ場合は、設定ファイルのパスを指定します。
+# (書き方は stations.example.json を参照。指定した場合、上の子機情報・リーダー・モーター・ピンの設定は
+#  設定ファイルで省略した項目の既定値として使われます)
+# 例: STATIONS_FILE = 'stations.json'
+STATIONS_FILE = None
+
 # --------------------------------------------------------------------------
 # --- ★★★ 設定はここまで ★★★ ---
 # --------------------------------------------------------------------------
 
 import time
-import requests
+import asyncio
+import aiohttp
 import nfc
 import sys
 import threading
+import uuid
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+# --- 親機との通信設定 ---
+# 通信はすべてイベントループ上の非同期処理で行うため、親機の応答が遅れてもカードの読み取りは止まらない。
+HTTP_POOL_SIZE = 4             # 親機との接続を使い回す数 (全ての子機で共有する)
+LOG_QUEUE_SIZE = 1000          # 送信待ちにできるログの数 (超えた分は捨てる)
+SHUTDOWN_LOG_FLUSH_SECONDS = 3 # 終了時に送信待ちのログを送り切るまで待つ秒数
+
+# --- 利用記録の送信設定 ---
+# 利用記録はタップごとのID (tap_id) 付きで送るため、親機に届いていても再送で二重に記録されない。
+# そのためタイムアウトを短くして、応答が遅いときはすぐに再送する。
+USAGE_TIMEOUT = 1.5            # 1回の送信で応答を待つ秒数
+USAGE_MAX_ATTEMPTS = 4         # 最大送信回数
+USAGE_RETRY_BACKOFF = 0.2      # 再送までの待ち時間 (秒)。回数ごとに倍にする
+
+# --- 子機設定の既定値 ---
+# 親機から設定が届くまで、または届いた値が不正なときに使う
+DEFAULT_SETTINGS = {
+    'heartbeat_interval': 30,      # ハートビート送信間隔 (秒)
+    'indicate_seconds': 2,         # LEDの点灯時間 (秒)
+    'dispense_max_attempts': 15,   # センサー連携時のモーター試行回数の上限
+}
+
+# 親機との通信で発生しうる例外 (接続エラーとタイムアウト)
+NETWORK_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
 
 # --- ライブラリの初期化 ---
+def load_motor_library(control_method):
+    """制御方法に応じたモーター制御ライブラリを読み込む"""
+    global Adafruit_PCA9685, serial
+    if control_method == 'RASPI_DIRECT':
+        import Adafruit_PCA9685
+        print("INFO: モード -> ラズパイ直結 (PCA9685)")
+    elif control_method == 'ARDUINO_SERIAL':
+        import serial
+        print("INFO: モード -> Arduino経由 (シリアル通信)")
+
 PLATFORM = "RASPI"
 if PLATFORM == "RASPI":
     try:
         import RPi.GPIO as GPIO
         GPIO.setmode(GPIO.BCM)
-        GPIO.setup(GREEN_LED_PIN, GPIO.OUT)
-        GPIO.setup(RED_LED_PIN, GPIO.OUT)
-        
-        if CONTROL_METHOD == 'RASPI_DIRECT':
-            import Adafruit_PCA9685
-            print("INFO: モード -> ラズパイ直結 (PCA9685)")
-        elif CONTROL_METHOD == 'ARDUINO_SERIAL':
-            import serial
-            print("INFO: モード -> Arduino経由 (シリアル通信)")
-        
-        if USE_SENSOR:
-            GPIO.setup(SENSOR_PIN, GPIO.IN)
-            print(f"INFO: センサーを利用します (GPIO {SENSOR_PIN})")
-        else:
-            print("INFO: センサーは利用しません。")
-
     except (ImportError, RuntimeError) as e:
         print(f"警告: ライブラリ読込失敗: {e}。PCモードで続行します。")
         PLATFORM = "PC"
 
-# --- 親機サーバー連携 ---
-
-def send_heartbeat():
-    """定期的に親機にハートビートを送信する"""
-    while True:
-        try:
-            payload = {"name": UNIT_NAME, "password": UNIT_PASSWORD}
-            requests.post(f"{SERVER_URL}/api/unit/heartbeat", json=payload, timeout=5)
-        except requests.exceptions.RequestException as e:
-            print(f"!! ハートビート送信失敗: {e}")
-        time.sleep(30) # 30秒ごとに送信
+# --- 非同期処理の共通部品 ---
+# main() の中で作成し、全ての子機で共有する
+event_loop = None     # イベントループ (スレッドからログを渡すときに使う)
+http_session = None   # 親機との接続プール
+log_queue = None      # 親機へ送るログの待ち行列 ((子機, メッセージ) の組)
+reader_stop = threading.Event()  # NFCリーダーの待ち受けを止める合図
 
-def check_server_connection():
-    """親機サーバーとの接続を確認する"""
-    try:
-        response = requests.get(f"{SERVER_URL}/api/health", timeout=3)
-        if response.status_code == 200 and response.json().get('status') == 'ok':
-            print(f"◎ 親機サーバーとの接続に成功しました。 ({SERVER_URL})")
-            return True
-        else:
-            print(f"!! 親機サーバーとの接続に失敗しました。ステータス: {response.status_code}")
-            return False
-    except requests.exceptions.RequestException as e:
-        print(f"!! 親機サーバーに接続できません: {e}")
-        return False
+async def run_blocking(func, *args):
+    """LEDやモーターなど時間のかかる同期処理を、イベントループを止めないよう別スレッドで実行する"""
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
 
-def send_log_to_server(message):
-    """親機にログを送信する (子機名を添えて)"""
-    log_message = f"[{UNIT_NAME}] {message}"
-    print(f"[ログ送信] {log_message}")
-    try:
-        # 子機名とメッセージをセットで送信
-        payload = {"unit_name": UNIT_NAME, "message": message}
-        requests.post(f"{SERVER_URL}/api/log", json=payload, timeout=3)
-    except requests.exceptions.RequestException as e:
-        print(f"!! 親機へのログ送信に失敗しました: {e}")
-
-# --- LED・モーター制御（Raspberry Piの場合のみ） ---
-
-def indicate(status):
-    """成功/失敗をLEDで示す"""
-    if PLATFORM != "RASPI":
-        return # PCモードでは何もしない
-
-    if status == "success":
-        pin = GREEN_LED_PIN
-    else: # "failure"
-        pin = RED_LED_PIN
-
-    GPIO.output(pin, GPIO.HIGH)
-    time.sleep(2)  # 2秒間点灯
-    GPIO.output(pin, GPIO.LOW)
-
-def dispense_with_raspi_direct():
-    """【ラズパイ直結】PCA9685でサーボモーターとセンサーを制御"""
-    print("INFO: ラズパイ直結でサーボモーターを制御します。")
+async def read_json(response):
+    """応答のJSONを読む。JSONでなければ None を返す"""
     try:
-        pwm = Adafruit_PCA9685.PCA9685()
-        pwm.set_pwm_freq(60)
-        gpio_sensor = 22
-        GPIO.setup(gpio_sensor, GPIO.IN)
-        time_start = time.time()
-        attempts = 0
-        while True:
-            elapsed = time.time() - time_start
-            sensor_val = GPIO.input(gpio_sensor)
-            print(f'Time: {elapsed:.1f}s, Sensor: {sensor_val}')
-
-            if sensor_val == 0:  # 反応あり: まだ排出されていない / 物が詰まり? -> 小刻み動作
-                pwm.set_pwm(15, 0, 5)
-                time.sleep(0.4)
-                pwm.set_pwm(15, 0, 0)
-                time.sleep(1)
-                attempts += 1
-                if attempts >= 5:
-                    print("排出リミットに達しました。")
-                    send_log_to_server("排出リミット到達 (5回)")
-                    break
-            else:  # 反応なし: 排出成功
-                pwm.set_pwm(15, 0, 100)
-                time.sleep(0.2)
-                pwm.set_pwm(15, 0, 0)
-                time.sleep(0.1)
-                print("排出が完了しました。")
-                send_log_to_server("排出完了")
+        return await response.json(content_type=None)
+    except ValueError:
+        return None
+
+# --- 子機 (NFCリーダーとモーターの組) ---
+class Station:
+    """
+    1組のNFCリーダーとモーター。親機からは1台の子機として見える。
+    子機ごとに認証トークンと、ハートビートで配信される設定のキャッシュを持つ。
+    """
+
+    def __init__(self, name, password, nfc_device=NFC_DEVICE, motor_type=MOTOR_TYPE,
+                 control_method=CONTROL_METHOD, use_sensor=USE_SENSOR, arduino_port=ARDUINO_PORT,
+                 green_led_pin=GREEN_LED_PIN, red_led_pin=RED_LED_PIN, sensor_pin=SENSOR_PIN,
+                 servo_channel=15):
+        self.name = name
+        self.password = password
+        self.nfc_device = nfc_device
+        self.motor_type = motor_type
+        self.control_method = control_method
+        self.use_sensor = use_sensor
+        self.arduino_port = arduino_port
+        self.green_led_pin = green_led_pin
+        self.red_led_pin = red_led_pin
+        self.sensor_pin = sensor_pin
+        self.servo_channel = servo_channel
+        # 子機自身の設定のモーター設定 (親機の上書きが外されたらこの値に戻す)
+        self.local_motor_settings = {
+            'motor_type': motor_type,
+            'control_method': control_method,
+            'use_sensor': use_sensor,
+        }
+
+        # 親機から配信される子機設定。
+        # ハートビートの応答に載ってくる設定をキャッシュし、カードタッチ時はこれを見て判断する。
+        # version が0の間 (未取得) は、子機側では利用可否・在庫のチェックを行わない。
+        # モーター制御のスレッドからも読むため、スレッド用のロックで守る。
+        self.config_lock = threading.Lock()
+        self.config = {
+            'version': 0,
+            'available': True,
+            'stock': None,
+            'settings': dict(DEFAULT_SETTINGS),
+        }
+
+        # 親機から受け取った認証トークン (名前とパスワードを送るのは取得時の1回だけ)
+        # asyncio.Lock はイベントループの外で作ると古いPython (3.9) で別のループに結び付くため、初回の使用時に作る
+        self.token_lock = None
+        self.token = None
+        self.token_expires_at = 0
+
+        # 同じ子機で排出が重ならないようにする
+        self.dispense_lock = threading.Lock()
+
+    @classmethod
+    def from_dict(cls, data):
+        """設定ファイルの1項目から子機を作る"""
+        return cls(**data)
+
+    def setup_hardware(self):
+        """LED・センサーのピンとモーター制御ライブラリを準備する"""
+        global PLATFORM
+        if PLATFORM != "RASPI":
+            return
+        try:
+            GPIO.setup(self.green_led_pin, GPIO.OUT)
+            GPIO.setup(self.red_led_pin, GPIO.OUT)
+            load_motor_library(self.control_method)
+            if self.use_sensor:
+                GPIO.setup(self.sensor_pin, GPIO.IN)
+                print(f"INFO: [{self.name}] センサーを利用します (GPIO {self.sensor_pin})")
+            else:
+                print(f"INFO: [{self.name}] センサーは利用しません。")
+        except (ImportError, RuntimeError) as e:
+            print(f"警告: ライブラリ読込失敗: {e}。PCモードで続行します。")
+            PLATFORM = "PC"
+
+    # --- 親機から配信される子機設定 ---
+
+    def apply_config(self, config):
+        """親機から受け取った設定をキャッシュに反映し、モーター設定の上書きを適用する"""
+        with self.config_lock:
+            self.config['version'] = config.get('version', self.config['version'])
+            self.config['available'] = bool(config.get('available', True))
+            self.config['stock'] = config.get('stock')
+            # 親機は既定値を含めた全ての設定を送るため、前回の値に重ねずに置き換える
+            self.config['settings'] = dict(DEFAULT_SETTINGS, **config.get('settings', {}))
+            settings = dict(self.config['settings'])
+        print(f"INFO: [{self.name}] 子機設定を更新しました (version {self.config['version']}, "
+              f"利用可: {self.config['available']}, 在庫: {self.config['stock']})")
+
+        # モーター設定の上書き (指定されていないものは子機自身の設定に戻す)
+        motor = dict(self.local_motor_settings, **{
+            key: settings[key] for key in self.local_motor_settings if key in settings
+        })
+        control_method_changed = motor['control_method'] != self.control_method
+        self.motor_type = motor['motor_type']
+        self.control_method = motor['control_method']
+        self.use_sensor = bool(motor['use_sensor'])
+        if PLATFORM == "RASPI":
+            try:
+                if control_method_changed:
+                    load_motor_library(self.control_method)
+                if self.use_sensor:
+                    GPIO.setup(self.sensor_pin, GPIO.IN)
+            except (ImportError, RuntimeError) as e:
+                self.log(f"子機設定の適用に失敗しました: {e}")
+
+    def get_setting(self, key):
+        """キャッシュ済みの子機設定から値を取り出す (正の数でなければ既定値を返す)"""
+        with self.config_lock:
+            value = self.config['settings'].get(key)
+        # 不正な値 ("abc" や 0) で送信ループが止まったり空回りしたりしないようにする
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            return DEFAULT_SETTINGS[key]
+        return value
+
+    # --- 親機サーバー連携 ---
+
+    async def fetch_token(self):
+        """名前とパスワードで親機から認証トークンを取得する。失敗した場合は None を返す"""
+        payload = {"name": self.name, "password": self.password}
+        timeout = aiohttp.ClientTimeout(total=5)
+        async with http_session.post(f"{SERVER_URL}/api/unit/token", json=payload, timeout=timeout) as response:
+            if response.status not in (200, 201):
+                print(f"!! [{self.name}] 認証トークンの取得に失敗しました: HTTP {response.status}")
+                return None
+            data = await read_json(response)
+        if not data or 'token' not in data or 'expires_in' not in data:
+            print(f"!! [{self.name}] 認証トークンの応答を解釈できませんでした。")
+            return None
+        self.token = data['token']
+        # 期限切れの少し前に取り直す
+        self.token_expires_at = time.time() + data['expires_in'] * 0.9
+        return self.token
+
+    async def get_token(self):
+        """有効な認証トークンを返す (未取得または期限が近ければ取り直す)"""
+        # 複数の処理が同時に期限切れに気づいても、取得は1回で済むようにする
+        if self.token_lock is None:
+            self.token_lock = asyncio.Lock()
+        async with self.token_lock:
+            if self.token and time.time() < self.token_expires_at:
+                return self.token
+            return await self.fetch_token()
+
+    async def request(self, method, path, timeout=5, **kwargs):
+        """
+        認証トークンを付けて親機にリクエストを送り、(HTTPステータス, JSON) を返す。
+        トークンが拒否された (失効・親機の再起動など) 場合は、取り直して1回だけ再送する。
+        timeout 秒で応答がなければ asyncio.TimeoutError を送出する。
+        """
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        for attempt in range(2):
+            token = await self.get_token() if attempt == 0 else await self.fetch_token()
+            headers = {"Authorization": f"Bearer {token}"} if token else {}
+            async with http_session.request(method, f"{SERVER_URL}{path}", headers=headers,
+                                            timeout=client_timeout, **kwargs) as response:
+                status = response.status
+                data = await read_json(response)
+            if status != 401:
                 break
-    except Exception as e:
-        msg = f"モーター/センサー制御エラー: {e}"
-        print(f"!! {msg}")
-        send_log_to_server(msg)
-        indicate("failure")
-    finally:
-        # センサーのみクリーンアップ (LED等は継続利用) ※存在しない場合の例外は無視
+        return status, data
+
+    async def record_usage(self, card_id):
+        """
+        利用記録を親機に送信し、(HTTPステータス, JSON) を返す。
+        同じタップIDで再送するので、通信エラーやタイムアウトでも安全にやり直せる。
+        全ての送信が失敗した場合は最後の例外を送出する。
+        """
+        payload = {"card_id": card_id, "tap_id": uuid.uuid4().hex}
+        for attempt in range(USAGE_MAX_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(USAGE_RETRY_BACKOFF * (2 ** (attempt - 1)))
+            try:
+                status, data = await self.request("POST", "/api/record_usage", json=payload, timeout=USAGE_TIMEOUT)
+            except NETWORK_ERRORS as e:
+                print(f"!! [{self.name}] 利用記録の送信に失敗しました ({attempt + 1}/{USAGE_MAX_ATTEMPTS}回目): {e!r}")
+                if attempt == USAGE_MAX_ATTEMPTS - 1:
+                    raise
+                continue
+            # 親機側の一時的なエラーも再送する
+            if status < 500 or attempt == USAGE_MAX_ATTEMPTS - 1:
+                return status, data
+            print(f"!! [{self.name}] 利用記録の送信でサーバーエラー ({attempt + 1}/{USAGE_MAX_ATTEMPTS}回目): HTTP {status}")
+
+    def log(self, message):
+        """
+        親機にログを送信する (子機名を添えて)。
+        送信は log_sender がまとめて行うので、どのスレッドから呼んでもすぐに戻る。
+        """
+        print(f"[ログ送信] [{self.name}] {message}")
+        if event_loop is None or event_loop.is_closed():
+            return
+        event_loop.call_soon_threadsafe(enqueue_log, self, message)
+
+    # --- LED・モーター制御（Raspberry Piの場合のみ） ---
+    # いずれも時間のかかる同期処理なので、イベントループからは run_blocking で呼び出す。
+
+    def indicate(self, status):
+        """成功/失敗をLEDで示す"""
+        if PLATFORM != "RASPI":
+            return # PCモードでは何もしない
+
+        if status == "success":
+            pin = self.green_led_pin
+        else: # "failure"
+            pin = self.red_led_pin
+
+        GPIO.output(pin, GPIO.HIGH)
+        time.sleep(self.get_setting('indicate_seconds'))  # 既定は2秒間点灯
+        GPIO.output(pin, GPIO.LOW)
+
+    def dispense_with_raspi_direct(self):
+        """【ラズパイ直結】PCA9685でサーボモーターとセンサーを制御"""
+        print(f"INFO: [{self.name}] ラズパイ直結でサーボモーターを制御します。")
+        gpio_sensor = self.sensor_pin
         try:
-            GPIO.cleanup(gpio_sensor)
-        except Exception:
-            pass
+            pwm = Adafruit_PCA9685.PCA9685()
+            pwm.set_pwm_freq(60)
+            GPIO.setup(gpio_sensor, GPIO.IN)
+            time_start = time.time()
+            attempts = 0
+            while True:
+                elapsed = time.time() - time_start
+                sensor_val = GPIO.input(gpio_sensor)
+                print(f'Time: {elapsed:.1f}s, Sensor: {sensor_val}')
+
+                if sensor_val == 0:  # 反応あり: まだ排出されていない / 物が詰まり? -> 小刻み動作
+                    pwm.set_pwm(self.servo_channel, 0, 5)
+                    time.sleep(0.4)
+                    pwm.set_pwm(self.servo_channel, 0, 0)
+                    time.sleep(1)
+                    attempts += 1
+                    if attempts >= 5:
+                        print("排出リミットに達しました。")
+                        self.log("排出リミット到達 (5回)")
+                        break
+                else:  # 反応なし: 排出成功
+                    pwm.set_pwm(self.servo_channel, 0, 100)
+                    time.sleep(0.2)
+                    pwm.set_pwm(self.servo_channel, 0, 0)
+                    time.sleep(0.1)
+                    print("排出が完了しました。")
+                    self.log("排出完了")
+                    break
+        except Exception as e:
+            msg = f"モーター/センサー制御エラー: {e}"
+            print(f"!! {msg}")
+            self.log(msg)
+            self.indicate("failure")
+        finally:
+            # センサーのみクリーンアップ (LED等は継続利用) ※存在しない場合の例外は無視
+            try:
+                GPIO.cleanup(gpio_sensor)
+            except Exception:
+                pass
 
-def dispense_with_arduino_serial():
-    """【Arduino経由】設定に応じてステッピングモーターを制御"""
-    print(f"INFO: Arduino経由で制御開始 (センサー利用: {USE_SENSOR})")
-    try:
-        # 「かんたん設定」で指定されたポートに接続
-        ser = serial.Serial(ARDUINO_PORT, 9600, timeout=1)
-        time.sleep(2) # Arduinoの起動を待つ
-
-        # === センサーを利用する場合のロジック ===
-        if USE_SENSOR:
-            print("センサーと連携したモーター制御を開始します。")
-            # 無限ループを避けるため、最大15回（約3秒）でタイムアウト
-            max_attempts = 15
-            for attempt in range(max_attempts):
-                time.sleep(0.2)
-                input_sensor = GPIO.input(SENSOR_PIN)
-                print(f"  -> 試行 {attempt + 1}: センサー値 = {input_sensor}")
-                if input_sensor == 1:
-                    print("     -> 前進命令 'F' を送信")
-                    ser.write(b'F')
+    def dispense_with_arduino_serial(self):
+        """【Arduino経由】設定に応じてステッピングモーターを制御"""
+        print(f"INFO: [{self.name}] Arduino経由で制御開始 (センサー利用: {self.use_sensor})")
+        try:
+            # 子機ごとに指定されたポートに接続
+            ser = serial.Serial(self.arduino_port, 9600, timeout=1)
+            time.sleep(2) # Arduinoの起動を待つ
+
+            # === センサーを利用する場合のロジック ===
+            if self.use_sensor:
+                print("センサーと連携したモーター制御を開始します。")
+                # 無限ループを避けるため、最大15回（約3秒, 親機から変更可）でタイムアウト
+                max_attempts = int(self.get_setting('dispense_max_attempts'))
+                for attempt in range(max_attempts):
+                    time.sleep(0.2)
+                    input_sensor = GPIO.input(self.sensor_pin)
+                    print(f"  -> 試行 {attempt + 1}: センサー値 = {input_sensor}")
+                    if input_sensor == 1:
+                        print("     -> 前進命令 'F' を送信")
+                        ser.write(b'F')
+                    else:
+                        print("     -> 排出完了。微調整命令 'S' を送信")
+                        ser.write(b'S')
+                        break
                 else:
-                    print("     -> 排出完了。微調整命令 'S' を送信")
+                    print("警告: タイムアウトしました。停止命令を送信します。")
                     ser.write(b'S')
-                    break
             else:
-                print("警告: タイムアウトしました。停止命令を送信します。")
-                ser.write(b'S')
-        else:
-            print("センサーを使わず、固定動作命令 '1' を送信します。")
-            ser.write(b'1')
-        ser.close()
-        print("✅ モーター制御完了。")
-    except Exception as e:
-        error_message = f"Arduino制御中にエラー発生: {e}"
-        print(f"!! {error_message}")
-        send_log_to_server(error_message)
-
-def dispense_item():
-    """設定に応じて適切なモーター制御関数を呼び出す"""
-    if PLATFORM != "RASPI":
-        print("モーター制御はRaspberry Piモードでのみ有効です。")
-        return
-
-    # 設定の組み合わせに応じて処理を分岐
-    if MOTOR_TYPE == 'SERVO' and CONTROL_METHOD == 'RASPI_DIRECT':
-        dispense_with_raspi_direct()
-    elif MOTOR_TYPE == 'STEPPER' and CONTROL_METHOD == 'ARDUINO_SERIAL':
-        dispense_with_arduino_serial()
-    else:
-        # サポートされていない組み合わせの場合
-        error_message = f"未サポートのモーター設定です: MOTOR_TYPE='{MOTOR_TYPE}', CONTROL_METHOD='{CONTROL_METHOD}'"
-        print(f"!! {error_message}")
-        send_log_to_server(error_message)
-        indicate("failure")
-
-# --- NFCカード処理 ---
-def handle_card_touch(tag):
-    """NFCカードがタッチされた時のメイン処理"""
-    if not isinstance(tag, nfc.tag.tt3.Type3Tag):
-        return False
+                print("センサーを使わず、固定動作命令 '1' を送信します。")
+                ser.write(b'1')
+            ser.close()
+            print("✅ モーター制御完了。")
+        except Exception as e:
+            error_message = f"Arduino制御中にエラー発生: {e}"
+            print(f"!! {error_message}")
+            self.log(error_message)
+
+    def dispense_item(self):
+        """設定に応じて適切なモーター制御関数を呼び出す"""
+        if PLATFORM != "RASPI":
+            print("モーター制御はRaspberry Piモードでのみ有効です。")
+            return
+
+        with self.dispense_lock:
+            # 設定の組み合わせに応じて処理を分岐
+            if self.motor_type == 'SERVO' and self.control_method == 'RASPI_DIRECT':
+                self.dispense_with_raspi_direct()
+            elif self.motor_type == 'STEPPER' and self.control_method == 'ARDUINO_SERIAL':
+                self.dispense_with_arduino_serial()
+            else:
+                # サポートされていない組み合わせの場合
+                error_message = (f"未サポートのモーター設定です: MOTOR_TYPE='{self.motor_type}', "
+                                 f"CONTROL_METHOD='{self.control_method}'")
+                print(f"!! {error_message}")
+                self.log(error_message)
+                self.indicate("failure")
+
+    # --- NFCカード処理 ---
+
+    async def handle_card_touch(self, card_id):
+        """NFCカードがタッチされた時のメイン処理 (イベントループ上で実行する)"""
+        print(f"[{self.name}] カードを検出: {card_id}")
+
+        # 0. 親機から配信された子機設定で、問い合わせ前に利用可否と在庫を確認
+        with self.config_lock:
+            unit_available = self.config['available']
+            unit_stock = self.config['stock']
+        if not unit_available:
+            self.log(f"子機が利用停止中のため利用不可 ({card_id})")
+            await run_blocking(self.indicate, "failure")
+            return False
+        if unit_stock is not None and unit_stock <= 0:
+            self.log(f"子機の在庫切れのため利用不可 ({card_id})")
+            await run_blocking(self.indicate, "failure")
+            return False
 
-    card_id = tag.idm.hex()
-    print(f"カードを検出: {card_id}")
+        # 1. 親機にカード情報を問い合わせ
+        try:
+            status, user = await self.request("GET", f"/api/users/{card_id}", timeout=5)
+
+            if status == 200:
+                if user is None:
+                    self.log(f"サーバーから不正なレスポンス (JSONデコード失敗) ({card_id})")
+                    await run_blocking(self.indicate, "failure")
+                    return False
+
+                # 2. 利用可能かチェック
+                if int(user.get('allow', 0)) != 1:
+                    self.log(f"利用不許可のカード ({card_id})")
+                    await run_blocking(self.indicate, "failure")
+                    return False
+                if int(user.get('stock', 0)) <= 0:
+                    self.log(f"在庫不足のため利用不可 ({card_id})")
+                    await run_blocking(self.indicate, "failure")
+                    return False
+
+                # 3. 利用記録を親機に送信
+                usage_status, usage = await self.record_usage(card_id)
+                if usage_status == 200:
+                    print(f"◎ [{self.name}] 利用成功")
+                    # 子機の在庫キャッシュを減らす (親機が新しい在庫数を返した場合はそれに合わせる)
+                    new_unit_stock = usage.get('unit_stock') if usage else None
+                    with self.config_lock:
+                        if new_unit_stock is not None:
+                            self.config['stock'] = new_unit_stock
+                        elif self.config['stock'] is not None:
+                            self.config['stock'] -= 1
+                    self.log(f"利用を記録しました ({card_id})")
+                    await run_blocking(self.indicate, "success")
+                    await run_blocking(self.dispense_item)  # 認証成功後に排出
+                    return True
+                else:
+                    if usage is not None:
+                        error_msg = usage.get('error', '不明なエラー')
+                    else:
+                        error_msg = '不明なエラー (JSONデコード失敗)'
+                    self.log(f"利用記録に失敗: {error_msg} ({card_id})")
+                    await run_blocking(self.indicate, "failure")
+                    return False
+
+            elif status == 404:
+                self.log(f"未登録カードのため利用不可 ({card_id})")
+                await run_blocking(self.indicate, "failure")
+                return False
+            else:
+                self.log(f"サーバー問い合わせエラー: HTTP {status} ({card_id})")
+                await run_blocking(self.indicate, "failure")
+                return False
 
-    # 1. 親機にカード情報を問い合わせ
-    try:
-        response = requests.get(f"{SERVER_URL}/api/users/{card_id}", timeout=5)
+        except NETWORK_ERRORS as e:
+            print(f"!! [{self.name}] 親機サーバーとの通信に失敗しました: {e!r}")
+            await run_blocking(self.indicate, "failure")
+            return False
 
-        if response.status_code == 200:
+    def reader_worker(self, loop):
+        """
+        NFCリーダーでカードを待ち受ける (子機ごとに別スレッドで動かす)。
+        カードの処理はイベントループに任せ、排出に成功した場合はカードが離れるまで待つ。
+        """
+        def on_connect(tag):
+            if not isinstance(tag, nfc.tag.tt3.Type3Tag):
+                return False
+            future = asyncio.run_coroutine_threadsafe(self.handle_card_touch(tag.idm.hex()), loop)
             try:
-                user = response.json()
-            except Exception:
-                send_log_to_server(f"サーバーから不正なレスポンス (JSONデコード失敗) ({card_id})")
-                indicate("failure")
+                return future.result()
+            except Exception as e:
+                print(f"!! [{self.name}] カード処理中にエラーが発生しました: {type(e).__name__}: {e}", file=sys.stderr)
                 return False
 
-            # 2. 利用可能かチェック
-            if int(user.get('allow', 0)) != 1:
-                send_log_to_server(f"利用不許可のカード ({card_id})")
-                indicate("failure")
-                return False
-            if int(user.get('stock', 0)) <= 0:
-                send_log_to_server(f"在庫不足のため利用不可 ({card_id})")
-                indicate("failure")
-                return False
+        # USB接続のNFCリーダーを初期化 (見つからない場合は IOError)
+        clf = nfc.ContactlessFrontend(self.nfc_device)
+        print(f"[{self.name}] NFCリーダー ({self.nfc_device}) の準備ができました。カードを待っています...")
+        try:
+            while not reader_stop.is_set():
+                # 接続待ち受け。終了の合図があれば待ち受けを抜ける
+                clf.connect(rdwr={'on-connect': on_connect}, terminate=reader_stop.is_set)
+                # カード処理が終わったら、次の読み取りのために少し待つ
+                time.sleep(1)
+        finally:
+            clf.close()
 
-            # 3. 利用記録を親機に送信
-            usage_response = requests.post(f"{SERVER_URL}/api/record_usage", json={"card_id": card_id}, timeout=5)
-            if usage_response.status_code == 200:
-                print("◎ 利用成功")
-                send_log_to_server(f"利用を記録しました ({card_id})")
-                indicate("success")
-                dispense_item()  # 認証成功後に排出
-                return True
-            else:
-                try:
-                    error_msg = usage_response.json().get('error', '不明なエラー')
-                except Exception:
-                    error_msg = '不明なエラー (JSONデコード失敗)'
-                send_log_to_server(f"利用記録に失敗: {error_msg} ({card_id})")
-                indicate("failure")
-                return False
+def load_stations():
+    """動かす子機の一覧を返す (STATIONS_FILE が未指定なら、かんたん設定の1台だけ)"""
+    if not STATIONS_FILE:
+        return [Station(UNIT_NAME, UNIT_PASSWORD)]
+    with open(STATIONS_FILE, encoding='utf-8') as f:
+        stations = [Station.from_dict(item) for item in json.load(f)['stations']]
+    names = [station.name for station in stations]
+    if not stations or len(set(names)) != len(names):
+        raise ValueError(f"{STATIONS_FILE}: 子機を1台以上、重複しない名前で指定してください。")
+    return stations
+
+# --- ハートビート・ログ送信 (全ての子機で共有) ---
+
+async def send_heartbeats_once(stations):
+    """全ての子機のハートビートを1回のリクエストにまとめて送り、設定が更新されていれば反映する"""
+    tokens = await asyncio.gather(*(station.get_token() for station in stations), return_exceptions=True)
+    beating = [(station, token) for station, token in zip(stations, tokens) if isinstance(token, str)]
+    if not beating:
+        print("!! ハートビートを送れる子機がありません (認証トークンを取得できませんでした)。")
+        return
+    payload = {"units": [
+        {"token": token, "config_version": station.config['version']}
+        for station, token in beating
+    ]}
+    try:
+        timeout = aiohttp.ClientTimeout(total=5)
+        async with http_session.post(f"{SERVER_URL}/api/unit/heartbeat/batch", json=payload,
+                                     timeout=timeout) as response:
+            status = response.status
+            data = await read_json(response)
+    except NETWORK_ERRORS as e:
+        print(f"!! ハートビート送信失敗: {e!r}")
+        return
+    if status != 200 or not data or len(data.get('results', [])) != len(beating):
+        print(f"!! ハートビートが拒否されました: HTTP {status}")
+        return
+    for (station, _), result in zip(beating, data['results']):
+        if result.get('status') == 401:
+            # トークンが失効していれば、次のハートビートまでに取り直す
+            station.token = None
+            print(f"!! [{station.name}] ハートビートが拒否されました: {result.get('error')}")
+        elif result.get('error'):
+            print(f"!! [{station.name}] ハートビートが拒否されました: {result.get('error')}")
+        elif result.get('config'):
+            station.apply_config(result['config'])
+
+async def heartbeat_loop(stations):
+    """定期的に親機にハートビートを送信する (間隔は子機の設定のうち最も短いもの)"""
+    while True:
+        interval = min(station.get_setting('heartbeat_interval') for station in stations)
+        await asyncio.sleep(interval)  # 既定は30秒ごとに送信
+        await send_heartbeats_once(stations)
 
-        elif response.status_code == 404:
-            send_log_to_server(f"未登録カードのため利用不可 ({card_id})")
-            indicate("failure")
-            return False
-        else:
-            send_log_to_server(f"サーバー問い合わせエラー: HTTP {response.status_code} ({card_id})")
-            indicate("failure")
+async def check_server_connection():
+    """親機サーバーとの接続を確認する"""
+    try:
+        timeout = aiohttp.ClientTimeout(total=3)
+        async with http_session.get(f"{SERVER_URL}/api/health", timeout=timeout) as response:
+            data = await read_json(response)
+            if response.status == 200 and data and data.get('status') == 'ok':
+                print(f"◎ 親機サーバーとの接続に成功しました。 ({SERVER_URL})")
+                return True
+            print(f"!! 親機サーバーとの接続に失敗しました。ステータス: {response.status}")
             return False
-
-    except requests.exceptions.RequestException as e:
-        print(f"!! 親機サーバーとの通信に失敗しました: {e}")
-        indicate("failure")
+    except NETWORK_ERRORS as e:
+        print(f"!! 親機サーバーに接続できません: {e!r}")
         return False
 
+def enqueue_log(station, message):
+    """ログを送信待ちに加える (イベントループ上で呼ばれる)"""
+    try:
+        log_queue.put_nowait((station, message))
+    except asyncio.QueueFull:
+        print("!! 送信待ちのログが多すぎるため、ログを破棄しました。")
+
+async def log_sender():
+    """送信待ちのログを順番に親機へ送る"""
+    while True:
+        station, message = await log_queue.get()
+        try:
+            # 子機名は親機が認証トークンから判断する
+            await station.request("POST", "/api/log", json={"message": message}, timeout=3)
+        except NETWORK_ERRORS as e:
+            print(f"!! [{station.name}] 親機へのログ送信に失敗しました: {e!r}")
+        finally:
+            log_queue.task_done()
+
+async def main(stations):
+    """子機の処理 (ハートビート・ログ送信・NFCリーダー) をまとめて動かす"""
+    global event_loop, http_session, log_queue
+    event_loop = asyncio.get_running_loop()
+    log_queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+    http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE))
+    tasks = []
+    readers = []
+    # リーダーの待ち受けは止まらないため、LEDやモーター用の既定のスレッドプール (run_blocking) とは
+    # 別に子機の数だけスレッドを用意する。共有すると子機が多いときにLEDの点灯を待ったまま止まる
+    reader_pool = ThreadPoolExecutor(max_workers=len(stations), thread_name_prefix='nfc-reader')
+    try:
+        # サーバー接続チェックを追加
+        if not await check_server_connection():
+            print("!! 処理を中断します。サーバーの設定や起動状態を確認してください。")
+            return 1 # 接続失敗時はスクリプトを終了する
+
+        # 最初のハートビートで子機設定を取得してから、残りをバックグラウンドで送信
+        await send_heartbeats_once(stations)
+        tasks.append(asyncio.create_task(heartbeat_loop(stations)))
+        tasks.append(asyncio.create_task(log_sender()))
+        print("◎ ハートビート送信を開始しました。")
+
+        # リーダーは子機ごとに専用のスレッドで待ち受ける。どれかが止まったら終了する
+        readers = [
+            event_loop.run_in_executor(reader_pool, station.reader_worker, event_loop)
+            for station in stations
+        ]
+        tasks.extend(readers)
+        done, _ = await asyncio.wait(readers, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+        return 0
+    except IOError:
+        print("エラー: NFCリーダーが見つかりません。接続を確認してください。")
+        return 1
+    finally:
+        reader_stop.set()
+        # 処理中のカードがあれば、親機とのやり取りを終えるまで待つ
+        if readers:
+            await asyncio.wait(readers)
+        reader_pool.shutdown(wait=False)
+        # 送信待ちのログをできるだけ送ってから終了する
+        try:
+            await asyncio.wait_for(log_queue.join(), SHUTDOWN_LOG_FLUSH_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await http_session.close()
+
 # --- メイン処理 ---
 if __name__ == "__main__":
     print(f"--- 子機クライアントを開始します (モード: {PLATFORM}) ---")
     print(f"接続先サーバー: {SERVER_URL}")
     print("Ctrl+Cで終了します。")
 
-    # サーバー接続チェックを追加
-    if not check_server_connection():
-        print("!! 処理を中断します。サーバーの設定や起動状態を確認してください。")
-        sys.exit(1) # 接続失敗時はスクリプトを終了する
-
-    # ハートビート送信をバックグラウンドで開始
-    heartbeat_thread = threading.Thread(target=send_heartbeat, daemon=True)
-    heartbeat_thread.start()
-    print("◎ ハートビート送信を開始しました。")
-
-    clf = None
+    exit_code = 0
     try:
-        # USB接続のNFCリーダーを初期化
-        clf = nfc.ContactlessFrontend('usb')
-        print("NFCリーダーの準備ができました。カードを待っています...")
-
-        while True:
-            # 接続待ち受け。rdwrにコールバック関数を指定。
-            clf.connect(rdwr={'on-connect': handle_card_touch})
-            # カード処理が終わったら、次の読み取りのために少し待つ
-            time.sleep(1)
-
-    except IOError:
-        print("エラー: NFCリーダーが見つかりません。接続を確認してください。")
+        stations = load_stations()
+        print(f"子機: {', '.join(station.name for station in stations)}")
+        for station in stations:
+            station.setup_hardware()
+        exit_code = asyncio.run(main(stations))
+    except KeyboardInterrupt:
+        pass
     except Exception as e:
         print(f"予期せぬエラーが発生しました: {type(e).__name__}: {e}", file=sys.stderr)
+        exit_code = 1
     finally:
-        if clf:
-            clf.close()
+        reader_stop.set()
         if PLATFORM == "RASPI":
             GPIO.cleanup()
-        print("\n--- スクリプトを終了します ---")
\ No newline at end of file
+        print("\n--- スクリプトを終了します ---")
+    sys.exit(exit_code)